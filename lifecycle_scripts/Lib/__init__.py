@@ -1,6 +1,32 @@
-from .aml_datalake_loader import DataLoader
-from .logger import Logger
-from .connectors import DataConnector
-from .compare_datasets import compare_columns, compare_content
-__all__ = ['DataLoader', 'Logger', 'compare_columns', 'compare_content']
+import importlib
+
+# Submodules are imported on first use of their names, so e.g. `from Lib import Logger` doesn't pull in
+# pandas, pyodbc or the Azure SDK. `from Lib import *` still imports everything in __all__.
+_exports = {
+    'DataLoader': 'aml_datalake_loader',
+    'Logger': 'logger',
+    'DataConnector': 'connectors',
+    'ReadSpec': 'read_spec',
+    'compare_columns': 'compare_datasets',
+    'compare_content': 'compare_datasets',
+    'run_comparison_streaming': 'compare_streaming',
+    'run_comparison_fingerprint': 'compare_fingerprints',
+    'ComparisonResult': 'compare_results',
+    'MismatchStore': 'compare_results',
+}
+
+def __getattr__(name):
+
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    value = getattr(importlib.import_module(f'.{_exports[name]}', __name__), name)
+    globals()[name] = value
+
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
+
+__all__ = ['DataLoader', 'Logger', 'ReadSpec', 'compare_columns', 'compare_content', 'run_comparison_streaming', 'run_comparison_fingerprint', 'ComparisonResult', 'MismatchStore']
 # __all__ = ['DataLoader', 'Logger']
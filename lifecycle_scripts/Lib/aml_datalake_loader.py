@@ -1,35 +1,101 @@
-from azure.identity import DefaultAzureCredential
-from azure.ai.ml import MLClient, Input
-from azure.ai.ml.constants import AssetTypes
 import pandas as pd
 import logging
+import hashlib
+import json
 import os
+import glob
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from .file_utils import atomic_path
+
+# 下载时每次读取的字节数
+CHUNK_SIZE = 8 * 2**20
+
+
+class LocalStorage:
+    """
+    本地文件系统存储，接口与 AzureStorage 相同，用于测试或读取已挂载的数据。
+    AML 数据资产对应 root 下同名的文件。
+    """
+
+    def __init__(self, root='.'):
+        self.root = root
+
+    def get_asset_path(self, name, version):
+        return os.path.join(self.root, name)
+
+    def info(self, path):
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'version': f'{stat.st_size}-{stat.st_mtime_ns}'}
+
+    def open(self, path, offset=0):
+        f = open(path, 'rb')
+        f.seek(offset)
+        return f
+
+
+class AzureStorage:
+    """
+    AML 工作区和 Data Lake 存储。文件通过 fsspec 读取（azureml:// 路径需要 azureml-fsspec），
+    version 使用 ETag，没有 ETag 时使用文件大小和修改时间。
+    """
+
+    def __init__(self, subscription_id, resource_group, workspace_name):
+        from azure.identity import DefaultAzureCredential
+        from azure.ai.ml import MLClient
+
+        self.credential = DefaultAzureCredential()
+        self.ml_client = MLClient(
+            credential=self.credential,
+            subscription_id=subscription_id,
+            resource_group_name=resource_group,
+            workspace_name=workspace_name,
+        )
+
+    def get_asset_path(self, name, version):
+        return self.ml_client.data.get(name=name, version=version).path
+
+    def info(self, path):
+        import fsspec
+
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        info = fs.info(fs_path)
+        version = info.get('etag') or info.get('ETag') or f"{info['size']}-{info.get('last_modified', '')}"
+        return {'size': info['size'], 'version': str(version).strip('"')}
+
+    def open(self, path, offset=0):
+        import fsspec
+
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        f = fs.open(fs_path, 'rb', block_size=CHUNK_SIZE)
+        f.seek(offset)
+        return f
 
 
 class DataLoader:
-    def __init__(self, source='aml', filename=None, output_dir='dataprep_input'):
+    def __init__(self, source='aml', filename=None, output_dir='dataprep_input', storage=None, asset_version=1):
         """
         初始化 DataLoader，指定数据来源、文件名和保存路径。
         :param source: 'aml' 或 'datalake'
         :param filename: 要读取的文件名（不含路径）
-        :param output_dir: 保存 CSV 的文件夹路径
+        :param output_dir: 保存 CSV 和 Parquet 的文件夹路径
+        :param storage: 可选，存储接口（默认 AzureStorage，测试时可用 LocalStorage）
+        :param asset_version: AML 数据资产的版本
         """
         self.source = source
         self.filename = filename
         self.output_dir = output_dir
+        self.asset_version = asset_version
         self.logger = logging.getLogger(__name__)
         logging.basicConfig(level=logging.INFO)
 
         self.subscription_id = "24fceea3-b944-4568-9028-d77c36beaab5"
         self.resource_group = "rg-machinelearning-prod-ae-001"
         self.workspace_name = "arriba-mlworkspace-prod-ae-001"
-        self.credential = DefaultAzureCredential()
-        self.ml_client = MLClient(
-            credential=self.credential,
-            subscription_id=self.subscription_id,
-            resource_group_name=self.resource_group,
-            workspace_name=self.workspace_name,
-        )
+        # 默认的 AzureStorage 在第一次使用时才创建
+        self._storage = storage
 
         self.default_datalake_prefix = (
             "azureml://subscriptions/24fceea3-b944-4568-9028-d77c36beaab5/"
@@ -38,9 +104,25 @@ class DataLoader:
             "datastores/stdataanalyticsadls001/paths/WilsonAI/"
         )
 
+        # manifest 记录每个本地文件对应的远程路径和版本，版本不变时跳过下载
+        self.manifest_path = os.path.join(self.output_dir, 'manifest.json')
+        self.download_dir = os.path.join(self.output_dir, '.downloads')
+        self.lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+
+    @property
+    def storage(self):
+        with self.lock:
+            if self._storage is None:
+                self._storage = AzureStorage(self.subscription_id, self.resource_group, self.workspace_name)
+        return self._storage
+
     def load_data(self, datalake_path=None):
         """
-        根据 source 加载数据并返回 DataFrame，并保存为 CSV 文件。
+        根据 source 加载数据并返回 DataFrame，本地副本保存为 CSV 和 Parquet 文件。
         :param datalake_path: 可选，完整的 Data Lake 路径（用于覆盖默认路径）
         :return: pandas DataFrame
         """
@@ -48,31 +130,157 @@ class DataLoader:
             if not self.filename:
                 raise ValueError(
                     "filename must be provided when source is 'aml'")
-            data_asset = self.ml_client.data.get(name=self.filename, version=1)
-            df = pd.read_csv(data_asset.path)
-            self.logger.info(
-                f"Loaded {len(df)} rows from AML data asset: {self.filename}")
+            item = self.filename
 
         elif self.source == 'datalake':
-            if datalake_path:
-                full_path = datalake_path
-            elif self.filename:
-                full_path = self.default_datalake_prefix + self.filename
-            else:
+            if not datalake_path and not self.filename:
                 raise ValueError(
                     "filename or datalake_path must be provided when source is 'datalake'")
-            input_data = Input(type=AssetTypes.URI_FILE, path=full_path)
-            df = pd.read_csv(input_data.path, header=None)
-            self.logger.info(
-                f"Loaded {len(df)} rows from Data Lake path: {full_path}")
+            item = datalake_path or self.filename
 
         else:
             raise ValueError("Invalid source. Must be 'aml' or 'datalake'.")
 
-        # 保存为 CSV 文件
-        os.makedirs(self.output_dir, exist_ok=True)
-        output_path = os.path.join(self.output_dir, self.filename)
-        df.to_csv(output_path, index=False)
-        self.logger.info(f"Saved DataFrame to {output_path}")
+        return self.load_item(item, name=self.filename)
+
+    def load_many(self, items, max_workers=4, read=True):
+        """
+        并行加载多个数据资产或 Data Lake 路径，版本未变的直接使用本地副本。
+        :param items: AML 数据资产名，或 Data Lake 文件名/完整路径的列表
+        :param max_workers: 最多同时下载的数量
+        :param read: False 时只更新本地副本，返回 Parquet 文件路径而不是 DataFrame
+        :return: {item: DataFrame 或路径}，加载失败的为 None
+        """
+        if self.source not in ['aml', 'datalake']:
+            raise ValueError("Invalid source. Must be 'aml' or 'datalake'.")
+
+        max_workers = max(min(max_workers, len(items)), 1)
+        self.logger.info(f"Loading {len(items)} items with {max_workers} workers")
+
+        def load(item):
+            try:
+                return self.load_item(item, read=read)
+            except Exception as e:
+                # 未完成的下载会保留，下次从断点继续
+                self.logger.error(f"Could not load {item}: {str(e)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {item: executor.submit(load, item) for item in items}
+            return {item: future.result() for item, future in futures.items()}
+
+    def load_item(self, item, name=None, read=True):
+        """
+        加载单个数据资产或路径：版本与 manifest 一致时读取本地 Parquet，否则（断点续传）下载后保存为 CSV 和 Parquet。
+        CSV 的文件名和格式与之前相同（output_dir/文件名），dataprep 和 notebook 读取的是 CSV；Parquet 用于下次直接加载。
+        从 Parquet 读取时，Data Lake 文件的列名恢复为 0, 1, 2...，混合类型的列为文本。
+        :param item: AML 数据资产名，或 Data Lake 文件名/完整路径
+        :param name: 可选，本地文件名（默认取路径中的文件名）
+        :param read: False 时返回 Parquet 文件路径而不是 DataFrame
+        """
+        if self.source == 'aml':
+            remote_path = self.storage.get_asset_path(item, self.asset_version)
+        elif '/' in item:
+            remote_path = item
+        else:
+            remote_path = self.default_datalake_prefix + item
+
+        filename = os.path.basename(name or remote_path.rstrip('/'))
+        name = os.path.splitext(filename)[0]
+        output_path = os.path.join(self.output_dir, f'{name}.parquet')
+        csv_path = os.path.join(self.output_dir, filename)
+        info = self.storage.info(remote_path)
+        version = f'{self.asset_version}:{info["version"]}' if self.source == 'aml' else info['version']
+
+        entry = self.manifest.get(name)
+        if entry and entry['path'] == remote_path and entry['version'] == version \
+                and os.path.exists(output_path) and os.path.exists(csv_path):
+            self.logger.info(f"{name} is up to date ({output_path})")
+            if not read:
+                return output_path
+            df = pd.read_parquet(output_path)
+            if self.source != 'aml':
+                df.columns = pd.RangeIndex(len(df.columns))
+            return df
+
+        raw_path = self.download(name, remote_path, info, version)
+
+        # Data Lake 上的文件没有表头
+        if self.source == 'aml':
+            df = pd.read_csv(raw_path)
+            self.logger.info(f"Loaded {len(df)} rows from AML data asset: {item}")
+        else:
+            df = pd.read_csv(raw_path, header=None)
+            self.logger.info(f"Loaded {len(df)} rows from Data Lake path: {remote_path}")
+
+        self.save_csv(df, csv_path)
+        self.save_parquet(df, output_path)
+        os.remove(raw_path)
+        self.logger.info(f"Saved DataFrame to {csv_path} and {output_path}")
+
+        with self.lock:
+            self.manifest[name] = {'path': remote_path, 'version': version, 'rows': len(df),
+                                   'loaded_at': datetime.now().isoformat(timespec='seconds')}
+            self.save_manifest()
+
+        return df if read else output_path
+
+    def download(self, name, remote_path, info, version):
+        """
+        下载到 .downloads 下的临时文件，文件名包含版本，已有部分下载时从断点继续。
+        :return: 下载完成的本地文件路径
+        """
+        os.makedirs(self.download_dir, exist_ok=True)
+        version_hash = hashlib.sha1(version.encode('utf-8')).hexdigest()[:12]
+        part_path = os.path.join(self.download_dir, f'{name}.{version_hash}.part')
+
+        # 其他版本的部分下载已经无用
+        for old_path in glob.glob(os.path.join(glob.escape(self.download_dir), f'{glob.escape(name)}.*.part')):
+            if old_path != part_path:
+                os.remove(old_path)
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > info['size']:
+            os.remove(part_path)
+            offset = 0
+        if offset > 0:
+            self.logger.info(f"Resuming download of {remote_path} from byte {offset} of {info['size']}")
+
+        with self.storage.open(remote_path, offset) as src, open(part_path, 'ab') as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+
+        size = os.path.getsize(part_path)
+        if size != info['size']:
+            raise IOError(f"Downloaded {size} of {info['size']} bytes from {remote_path}")
+
+        return part_path
+
+    def save_csv(self, df, csv_path):
+        """
+        保存为 CSV（先写临时文件再替换）。
+        """
+        with atomic_path(csv_path) as tmp_path:
+            df.to_csv(tmp_path, index=False)
+
+    def save_parquet(self, df, output_path):
+        """
+        保存为 Parquet（先写临时文件再替换）。Parquet 要求列名为字符串，混合类型的列保存为文本。
+        修改的是浅拷贝，传入的 df 不变。
+        """
+        df = df.copy(deep=False)
+        df.columns = [str(col) for col in df.columns]
+        for col in df.columns:
+            if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed'):
+                df[col] = df[col].astype(str).where(df[col].notna())
+
+        with atomic_path(output_path) as tmp_path:
+            df.to_parquet(tmp_path, index=False)
 
-        return df
+    def save_manifest(self):
+        with atomic_path(self.manifest_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.manifest, f, indent=4)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .file_utils import atomic_path
+
+# Keyword rules classifying activities from their activity and template names, e.g. from config.json:
+#
+#   "activity_rules": {
+#       "default": "Other",
+#       "activity": [["travel", "Travel"], ["report", "Report"], ["training", "Coaching"]],
+#       "template": [["contact", "Contact"], ["assessment", "Assessment"]],
+#       "type": [
+#           {"activity": ["Travel"], "use": "activity"},
+#           {"activity": ["Other"], "template": ["Report"], "use": "template"}
+#       ]
+#   }
+#
+# activity and template: (keyword, group) pairs, matched case-insensitively against the name. The first pair whose
+# keyword is in the name gives the group, the default group if none is (or the name is missing).
+# type: rules combining the two groups, the first one whose conditions hold says which group is the type
+# ('activity' or 'template'). Without a matching rule the type is the activity group.
+#
+# Names are classified once per distinct value and the groups mapped back to the rows by their codes,
+# so the cost depends on the number of distinct names rather than rows.
+#
+# With cache_path the group of every name seen is kept in a json file, together with a hash of the rules, and
+# only names not in it are classified. A change to the rules changes the hash and the cache starts over.
+
+class RuleClassifier:
+
+    def __init__(self, rules, cache_path=None):
+
+        self.rules = rules
+        self.default = rules.get('default', 'Other')
+        self.rules_hash = hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+        self.groups = [self.default]
+        for field in ['activity', 'template']:
+            for _, group in rules.get(field, []):
+                if group not in self.groups:
+                    self.groups.append(group)
+        self.group_ids = {group: i for i, group in enumerate(self.groups)}
+
+        # the type of every (activity group, template group) pair
+        n_groups = len(self.groups)
+        self.type_table = np.zeros((n_groups, n_groups), dtype=np.int32)
+        for a, activity_grp in enumerate(self.groups):
+            for t, template_grp in enumerate(self.groups):
+                self.type_table[a, t] = self.group_ids[self.get_type(activity_grp, template_grp)]
+
+        self.cache_path = cache_path
+        self.cache = {'activity': {}, 'template': {}}
+        self.cache_changed = False
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache.get('rules_hash')==self.rules_hash:
+                self.cache = {field: cache.get(field, {}) for field in ['activity', 'template']}
+
+    def get_type(self, activity_grp, template_grp):
+
+        for rule in self.rules.get('type', []):
+            if 'activity' in rule and activity_grp not in rule['activity']:
+                continue
+            if 'template' in rule and template_grp not in rule['template']:
+                continue
+            return activity_grp if rule['use']=='activity' else template_grp
+
+        return activity_grp
+
+    def classify_values(self, values, field):
+
+        # group ids of distinct names, from the cache for the ones seen before
+        if self.cache_path is None:
+            return self.match_values(values, field)
+
+        names = pd.Series(values, dtype=object).astype(str)
+        cached = names.map(self.cache[field]).to_numpy(dtype=object)
+        new = pd.isna(cached)
+        if new.any():
+            new_names = names[new]
+            groups = np.array(self.groups, dtype=object)[self.match_values(new_names.to_numpy(), field)]
+            self.cache[field].update(zip(new_names, groups))
+            cached[new] = groups
+            self.cache_changed = True
+
+        return pd.Series(cached, dtype=object).map(self.group_ids).to_numpy(dtype=np.int32)
+
+    def match_values(self, values, field):
+
+        # group ids of distinct names, the default for missing ones
+        lower = pd.Series(values, dtype=object).str.lower()
+        conditions = [lower.str.contains(keyword, regex=False, na=False).to_numpy() for keyword, _ in self.rules.get(field, [])]
+        choices = [self.group_ids[group] for _, group in self.rules.get(field, [])]
+        if len(conditions)==0:
+            return np.zeros(len(lower), dtype=np.int32)
+
+        return np.select(conditions, choices, default=0).astype(np.int32)
+
+    def classify_column(self, values, field):
+
+        # group id of every row
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values)
+
+        # missing names have code -1, which picks the default appended at the end
+        group_ids = np.append(self.classify_values(uniques, field), 0)
+
+        return group_ids[codes]
+
+    def classify(self, activity_names, template_names):
+
+        # Returns the activity group, template group and type of every row, as arrays of labels
+        activity_ids = self.classify_column(activity_names, 'activity')
+        template_ids = self.classify_column(template_names, 'template')
+        type_ids = self.type_table[activity_ids, template_ids]
+
+        if self.cache_changed:
+            self.save_cache()
+
+        labels = np.array(self.groups, dtype=object)
+
+        return labels[activity_ids], labels[template_ids], labels[type_ids]
+
+    def save_cache(self):
+
+        folder = os.path.dirname(self.cache_path) or '.'
+        os.makedirs(folder, exist_ok=True)
+        with atomic_path(self.cache_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump({'rules_hash': self.rules_hash, **self.cache}, f)
+        self.cache_changed = False
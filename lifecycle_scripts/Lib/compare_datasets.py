@@ -1,9 +1,15 @@
+import numpy as np
 import pandas as pd
 
-from libs.logger import Logger
+from .compare_results import ComparisonResult, MismatchStore, to_long_format
+from .logger import traced
+from .schemas import apply_schema, get_read_dtypes
+
+@traced
+def read_data(logger, fname, csv=False, full_path_provided=False, label='na', table_schema=None):
+
+    # table_schema: dtypes for the file from a schema registry (see schemas), instead of inferring them
 
-def read_data(logger, fname, csv=False, full_path_provided=False, label='na'):
-    
     data = None
     data_folder = None
 
@@ -14,9 +20,10 @@ def read_data(logger, fname, csv=False, full_path_provided=False, label='na'):
 
     try:
         if csv:
-            data = pd.read_csv(file_loc)
+            data = pd.read_csv(file_loc, dtype=get_read_dtypes(table_schema))
         else:
-            data = pd.read_csv(file_loc, delimiter='\t', low_memory=False)
+            data = pd.read_csv(file_loc, delimiter='\t', low_memory=False, dtype=get_read_dtypes(table_schema))
+        data = apply_schema(logger, data, table_schema)
         logger.debug(f'Read {str(len(data))} rows from {fname} ({label})')
     except Exception as e:
         logger.error('Unable to read data from ' + file_loc + ' - ' + str(e))
@@ -24,19 +31,105 @@ def read_data(logger, fname, csv=False, full_path_provided=False, label='na'):
     return data
 
 
-def test_pkey(logger, old_df, new_df, pkey):
+def get_key_cols(pkey):
+
+    # pkey is a column name, or a list of column names for a composite key
+    if isinstance(pkey, str):
+        return [pkey]
+
+    return list(pkey)
+
+class KeyIndex:
+
+    # The primary keys of both datasets factorised once into a shared integer code space, so that the pkey tests,
+    # the join tests and the alignment of matching rows all work on int arrays rather than sets of Python objects.
+    # Composite keys are factorised column by column and the codes combined.
+
+    def __init__(self, old_df, new_df, pkey):
+
+        self.key_cols = get_key_cols(pkey)
+        n_old = len(old_df)
+
+        codes = None
+        for col in self.key_cols:
+            col_codes, _ = pd.factorize(pd.concat([old_df[col], new_df[col]], ignore_index=True), use_na_sentinel=False)
+            if codes is None:
+                codes = col_codes
+            elif len(col_codes)>0:
+                # refactorise after each column so the combined codes stay small
+                codes, _ = pd.factorize(codes*(col_codes.max() + 1) + col_codes)
+
+        # no rows at all (e.g. an empty partition)
+        if len(codes)==0:
+            codes = np.zeros(0, dtype=np.int64)
+
+        self.n_keys = codes.max() + 1 if len(codes)>0 else 0
+        self.old_codes = codes[:n_old]
+        self.new_codes = codes[n_old:]
+
+        self.old_counts = np.bincount(self.old_codes, minlength=self.n_keys)
+        self.new_counts = np.bincount(self.new_codes, minlength=self.n_keys)
+
+    def n_old_keys(self):
+        return int((self.old_counts>0).sum())
+
+    def n_new_keys(self):
+        return int((self.new_counts>0).sum())
+
+    def n_old_only(self):
+        return int(((self.old_counts>0) & (self.new_counts==0)).sum())
+
+    def n_new_only(self):
+        return int(((self.new_counts>0) & (self.old_counts==0)).sum())
+
+    def align(self):
+
+        # Row positions of the rows with a key in both datasets, in the order of the old dataset
+        # (the same rows and order as an inner merge). Keys must be unique.
+        new_pos = np.full(self.n_keys, -1)
+        new_pos[self.new_codes] = np.arange(len(self.new_codes))
+
+        old_pos = np.flatnonzero(new_pos[self.old_codes]>=0)
+
+        return old_pos, new_pos[self.old_codes[old_pos]]
+
+def merge_on_key_index(old_df, new_df, key_index):
+
+    # Same result as old_df.merge(new_df, on=pkey), using the already factorised keys
+    old_pos, new_pos = key_index.align()
+
+    return merge_aligned(old_df, new_df, key_index.key_cols, old_pos, new_pos)
+
+def merge_aligned(old_df, new_df, key_cols, old_pos, new_pos):
+
+    # The merged rows for the given aligned row positions (from KeyIndex.align)
+    old_part = old_df.iloc[old_pos].reset_index(drop=True)
+    new_part = new_df.drop(columns=key_cols).iloc[new_pos].reset_index(drop=True)
+
+    overlap = set(old_part.columns).intersection(new_part.columns)
+    old_part = old_part.rename(columns={col: f'{col}_x' for col in overlap})
+    new_part = new_part.rename(columns={col: f'{col}_y' for col in overlap})
+
+    return pd.concat([old_part, new_part], axis=1)
+
+@traced
+def test_pkey(logger, old_df, new_df, pkey, key_index=None):
 
     # check key exists in both
-    if pkey not in old_df.columns or pkey not in new_df.columns:
+    key_cols = get_key_cols(pkey)
+    if any(col not in old_df.columns or col not in new_df.columns for col in key_cols):
         logger.error(f'Primary key {pkey} not found in one or both of the datasets')
         return False
 
+    if key_index is None:
+        key_index = KeyIndex(old_df, new_df, pkey)
+
     # check unique
-    if len(old_df) != len(old_df[pkey].unique()):
+    if len(old_df) != key_index.n_old_keys():
         logger.error(f'Primary key {pkey} not unique in old dataset')
         return False
 
-    if len(new_df) != len(new_df[pkey].unique()):
+    if len(new_df) != key_index.n_new_keys():
         logger.error(f'Primary key {pkey} not unique in new dataset')
         return False
 
@@ -44,29 +137,31 @@ def test_pkey(logger, old_df, new_df, pkey):
 
     return True
 
-def test_joins(logger, old_df, new_df, pkey):
+@traced
+def test_joins(logger, old_df, new_df, pkey, key_index=None):
 
     logger.debug('Testing joins', True)
 
-    old_keys = set(old_df[pkey])
-    new_keys = set(new_df[pkey])
-    both_keys = old_keys.intersection(new_keys)
+    if key_index is None:
+        key_index = KeyIndex(old_df, new_df, pkey)
+
+    log_join_results(logger, key_index.n_old_keys(), key_index.n_new_keys(), key_index.n_old_only(), key_index.n_new_only())
 
-    old_only = old_keys - both_keys
-    new_only = new_keys - both_keys
+def log_join_results(logger, n_old_keys, n_new_keys, n_old_only, n_new_only):
 
     issues_found = 0
-    if len(old_only)>0:
-        logger.warning(f'Rows in old not in new: {len(old_only)} ({100*round(len(old_only)/len(old_keys),4)}%)')
+    if n_old_only>0:
+        logger.warning(f'Rows in old not in new: {n_old_only} ({100*round(n_old_only/n_old_keys,4)}%)')
         issues_found += 1
-    if len(new_only)>0:
-        logger.warning(f'Rows in new not in old: {len(new_only)} ({100*round(len(new_only)/len(new_keys),4)}%)')
+    if n_new_only>0:
+        logger.warning(f'Rows in new not in old: {n_new_only} ({100*round(n_new_only/n_new_keys,4)}%)')
         issues_found += 1
 
     if issues_found==0:
         logger.debug('Join tests pass')
 
 
+@traced
 def compare_columns(logger, old_df, new_df):
 
     logger.debug('Comparing columns', True)
@@ -94,73 +189,256 @@ def compare_columns(logger, old_df, new_df):
     else:
         return False
 
-def compare_content(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances):
+def get_content_cols(old_cols, new_cols, pkey):
+
+    # keep the column order of the old dataset so reports are repeatable between runs
+    new_cols = set(new_cols)
+    key_cols = get_key_cols(pkey)
+    return [col for col in old_cols if col in new_cols and col not in key_cols]
+
+@traced
+def compare_content(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, key_index=None):
 
     logger.debug('Comparing content', True)
 
-    cols = set(old_df.columns).intersection(set(new_df.columns))
-    cols = cols - {pkey}
-
-    df = old_df.merge(new_df, on=pkey)
-    n_issues=0
-
-    for col in cols:
-        col_x = f'{col}_x'
-        col_y = f'{col}_y'
-                
-        if col in date_fields:
-            df['diff'] = compare_date_fields(df[col_x], df[col_y], day_first_in_dates)
-        elif df[col_x].dtype in ['float64', 'int64'] and df[col_y].dtype in ['float64', 'int64']:
-            if type(num_tolerances) is dict:
-                if col in num_tolerances:
-                    num_tolerance = num_tolerances[col]
-                else:
-                    num_tolerance = num_tolerances['default']
-            else:
-                num_tolerance = num_tolerances
+    cols = get_content_cols(old_df.columns, new_df.columns, pkey)
+
+    if key_index is None:
+        key_index = KeyIndex(old_df, new_df, pkey)
+
+    df = merge_on_key_index(old_df, new_df, key_index)
+
+    mismatches, _ = compare_blocks(df, df, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, suffixes=('_x', '_y'))
+    log_match_rates(logger, dict(zip(cols, len(df) - mismatches.sum(axis=0))), len(df))
+
+    # flag the rows where every column matches
+    df['diff'] = ~mismatches.any(axis=1)
+
+    return df
+
+@traced
+def compare_content_to_store(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, key_index, store, block_rows=100000):
+
+    # Same checks as compare_content, but the matching rows are merged and compared block_rows at a time and
+    # only the mismatching cells are kept, written to store in long format.
+    # Returns the number of rows compared and the number of matches per column.
+
+    logger.debug('Comparing content', True)
+
+    cols = get_content_cols(old_df.columns, new_df.columns, pkey)
+    old_pos, new_pos = key_index.align()
+
+    n_matches = dict.fromkeys(cols, 0)
+    for start in range(0, len(old_pos), block_rows):
+        df = merge_aligned(old_df, new_df, key_index.key_cols, old_pos[start:start + block_rows], new_pos[start:start + block_rows])
+        mismatches, _ = compare_blocks(df, df, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, suffixes=('_x', '_y'))
+
+        for col, n in zip(cols, mismatches.sum(axis=0)):
+            n_matches[col] += len(df) - int(n)
+
+        store.append(to_long_format(df, key_index.key_cols, cols, mismatches))
+
+    log_match_rates(logger, n_matches, len(old_pos))
+
+    return len(old_pos), n_matches
+
+def get_col_groups(old, new, cols, date_fields, datetime_fields, suffixes=('', '')):
+
+    # Split the columns by how they get compared. Numeric columns are split again into int and float
+    # so that int columns aren't cast to float (and lose precision) before being compared.
+    groups = {'date': [], 'int': [], 'float': [], 'string': []}
+
+    for i, col in enumerate(cols):
+        dtype_x = old[col + suffixes[0]].dtype
+        dtype_y = new[col + suffixes[1]].dtype
 
-            df['diff'] = compare_numerical_fields(df[col_x], df[col_y], num_tolerance)
+        if col in date_fields or col in datetime_fields:
+            groups['date'].append(i)
+        elif dtype_x=='int64' and dtype_y=='int64':
+            groups['int'].append(i)
+        elif dtype_x in ['float64', 'int64'] and dtype_y in ['float64', 'int64']:
+            groups['float'].append(i)
         else:
-            df[col_x].fillna('NA', inplace=True)
-            df[col_y].fillna('NA', inplace=True)
-            df['diff'] = df[col_x]==df[col_y]
-        diff_avg = df['diff'].mean()
-        if diff_avg<1:
-            if diff_avg>0.98:
-                logger.debug(f'Column {col} match rate: {diff_avg}')
-            elif diff_avg>0.9:
-                logger.warning(f'Column {col} match rate: {diff_avg}')
-            else:
-                logger.error(f'Column {col} match rate: {diff_avg}')
-            n_issues += 1
+            groups['string'].append(i)
+
+    return groups
+
+def compare_blocks(old, new, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, suffixes=('', '')):
+
+    # Compare row-aligned old and new frames on cols, one 2-D block per type of column rather than column by column.
+    # Both frames can be the same merged frame, with suffixes ('_x', '_y') picking the old and new columns.
+    # Returns a boolean mismatch matrix (rows x cols, in the order of cols) and the match rate of each column.
+    n_rows = len(old)
+    mismatches = np.zeros((n_rows, len(cols)), dtype=bool)
+
+    groups = get_col_groups(old, new, cols, date_fields, datetime_fields, suffixes)
+
+    for group, idx in groups.items():
+        if len(idx)==0:
+            continue
+
+        names_x = [cols[i] + suffixes[0] for i in idx]
+        names_y = [cols[i] + suffixes[1] for i in idx]
+
+        if group=='date':
+            # date fields are compared on the day only, datetime fields on the full timestamp
+            keep_time = [cols[i] in datetime_fields for i in idx]
+            old_block = np.column_stack([to_date_values(old[col], day_first_in_dates, keep) for col, keep in zip(names_x, keep_time)])
+            new_block = np.column_stack([to_date_values(new[col], day_first_in_dates, keep) for col, keep in zip(names_y, keep_time)])
+            mismatches[:, idx] = old_block!=new_block
+
+        elif group in ['int', 'float']:
+            # TODO: Implement a separate test for NAs, because we can accidentaly miss an issue if the correct value is 0, but one DF has missing values and we impute them to 0.
+            old_block = old[names_x].to_numpy(dtype=group + '64')
+            new_block = new[names_y].to_numpy(dtype=group + '64')
+            if group=='float':
+                old_block = np.where(np.isnan(old_block), 0.0, old_block)
+                new_block = np.where(np.isnan(new_block), 0.0, new_block)
+            tolerances = np.array([get_num_tolerance(num_tolerances, cols[i]) for i in idx])
+            mismatches[:, idx] = ~(np.abs(old_block - new_block) < tolerances)
+
+        else:
+            old_block = old[names_x].to_numpy(dtype=object)
+            new_block = new[names_y].to_numpy(dtype=object)
+            old_block = np.where(pd.isna(old_block), 'NA', old_block)
+            new_block = np.where(pd.isna(new_block), 'NA', new_block)
+            mismatches[:, idx] = ~(old_block==new_block)
+
+    if n_rows>0:
+        match_rates = dict(zip(cols, (n_rows - mismatches.sum(axis=0))/n_rows))
+    else:
+        match_rates = {}
+
+    return mismatches, match_rates
+
+def get_num_tolerance(num_tolerances, col):
+
+    if type(num_tolerances) is dict:
+        if col in num_tolerances:
+            return num_tolerances[col]
+        return num_tolerances['default']
+
+    return num_tolerances
+
+def log_match_rates(logger, n_matches, n_rows):
+
+    # n_matches holds the number of matching rows for each column, out of n_rows compared
+    n_issues = 0
+
+    if n_rows>0:
+        for col, n_match in n_matches.items():
+            diff_avg = n_match/n_rows
+            if diff_avg<1:
+                if diff_avg>0.98:
+                    logger.debug(f'Column {col} match rate: {diff_avg}')
+                elif diff_avg>0.9:
+                    logger.warning(f'Column {col} match rate: {diff_avg}')
+                else:
+                    logger.error(f'Column {col} match rate: {diff_avg}')
+                n_issues += 1
 
     if n_issues==0:
         logger.debug('Content matches exactly')
 
-    return df
+# Formats tried, in order, when inferring the format of a date column. Ambiguous day/month formats are tried
+# in the order given by day_first_in_dates.
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', 'ISO8601', '%Y%m%d']
+DAY_FIRST_FORMATS = ['%d/%m/%Y', '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d-%m-%Y', '%d-%b-%Y', '%d %b %Y']
+MONTH_FIRST_FORMATS = ['%m/%d/%Y', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S', '%m-%d-%Y']
 
-def compare_date_fields(old, new, dayfirst=False):
+def infer_date_format(values, dayfirst=False, sample_size=1000):
 
-    old_date = pd.to_datetime(old, errors='coerce', dayfirst=dayfirst)
-    new_date = pd.to_datetime(new, errors='coerce', dayfirst=dayfirst)
+    # Returns the first format that parses every value in a sample of the (string) values, or None
+    sample = [value for value in values[:sample_size] if isinstance(value, str)]
+    if len(sample)==0:
+        return None
 
-    old_date.fillna('1900-01-01', inplace=True)
-    new_date.fillna('1900-01-01', inplace=True)
+    if dayfirst:
+        formats = DATE_FORMATS + DAY_FIRST_FORMATS + MONTH_FIRST_FORMATS
+    else:
+        formats = DATE_FORMATS + MONTH_FIRST_FORMATS + DAY_FIRST_FORMATS
+
+    for fmt in formats:
+        try:
+            if pd.to_datetime(pd.Index(sample), format=fmt, errors='coerce').notna().all():
+                return fmt
+        except (ValueError, TypeError):
+            # e.g. ISO8601 isn't supported by older versions of pandas
+            continue
+
+    return None
+
+def parse_dates(values, dayfirst=False, fmt=None):
+
+    # Equivalent to pd.to_datetime(values, errors='coerce', dayfirst=dayfirst), returned as naive datetime64[ns],
+    # but each distinct value is parsed only once and with a format inferred from a sample of them where possible.
+    # Values that don't fit the inferred format fall back to the flexible parser.
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+
+    if fmt is None:
+        fmt = infer_date_format(uniques, dayfirst)
+
+    if fmt is not None:
+        parsed = to_naive_dates(pd.to_datetime(pd.Index(uniques), format=fmt, errors='coerce', utc=True))
+        failed = np.isnat(parsed)
+        if failed.any():
+            parsed[failed] = parse_dates_flexible(uniques[failed], dayfirst)
+    else:
+        parsed = parse_dates_flexible(uniques, dayfirst)
 
-    diff = old_date==new_date
+    return np.where(codes>=0, parsed[codes], np.datetime64('NaT', 'ns'))
 
-    return diff
+def parse_dates_flexible(values, dayfirst=False):
+
+    # Element by element parsing, which is what pandas<2 does by default (pandas>=2 needs format='mixed')
+    if int(pd.__version__.split('.')[0])>=2:
+        dates = pd.to_datetime(pd.Index(values), errors='coerce', dayfirst=dayfirst, utc=True, format='mixed')
+    else:
+        dates = pd.to_datetime(pd.Index(values), errors='coerce', dayfirst=dayfirst, utc=True)
+
+    return to_naive_dates(dates)
+
+def to_naive_dates(dates):
+
+    return dates.tz_convert(None).to_numpy(dtype='datetime64[ns]')
+
+def to_date_values(values, dayfirst=False, keep_time=True):
+
+    # Dates as datetime64[ns], with missing or unparseable dates set to 1900-01-01.
+    # With keep_time=False only the day is kept.
+    if pd.api.types.is_datetime64_any_dtype(values):
+        dates = pd.to_datetime(values, utc=True)
+        dates = to_naive_dates(pd.DatetimeIndex(dates))
+    elif values.dtype==object or pd.api.types.is_string_dtype(values):
+        dates = parse_dates(values.astype(object), dayfirst)
+    else:
+        dates = to_naive_dates(pd.DatetimeIndex(pd.to_datetime(values, errors='coerce', utc=True)))
+
+    if not keep_time:
+        dates = dates.astype('datetime64[D]').astype('datetime64[ns]')
+
+    dates[np.isnat(dates)] = np.datetime64('1900-01-01', 'ns')
+
+    return dates
+
+def compare_date_fields(old, new, dayfirst=False):
+
+    diff = to_date_values(old, dayfirst)==to_date_values(new, dayfirst)
+
+    return pd.Series(diff, index=old.index)
 
 def compare_numerical_fields(old, new, tolerance):
 
     # TODO: Implement a separate test for NAs, because we can accidentaly miss an issue if the correct value is 0, but one DF has missing values and we impute them to 0.
-    old.fillna(0, inplace=True)
-    new.fillna(0, inplace=True)
+    old = old.fillna(0)
+    new = new.fillna(0)
 
     diff = abs(old - new) < tolerance
 
     return diff
 
+@traced
 def store_results(logger, fname):
         
     body = ''
@@ -172,7 +450,15 @@ def store_results(logger, fname):
         f.write(body)
 
 
-def run_comparison(logger, old_df, new_df, pkey, old_cols_exclude, date_fields, datetime_fields, day_first_in_dates=False, num_tolerances=0.0001, out_file=None):
+@traced
+def run_comparison(logger, old_df, new_df, pkey, old_cols_exclude, date_fields, datetime_fields, day_first_in_dates=False, num_tolerances=0.0001, out_file=None, workers=1,
+                   mismatch_store=None, n_examples=5):
+
+    # pkey is a column name, or a list of column names for a composite key.
+    # With workers>1 both datasets are hash-partitioned on the pkey and the partitions compared in a process pool.
+    # The report and the combined frame are the same as for the serial run.
+    # With mismatch_store (a .parquet directory or a SQLite file) the merged frame isn't kept: mismatching cells
+    # are written to the store and a ComparisonResult with the counts and n_examples examples per column is returned.
 
     logger.debug('Starting comparison', True)
 
@@ -180,12 +466,26 @@ def run_comparison(logger, old_df, new_df, pkey, old_cols_exclude, date_fields,
 
     old_df.drop(columns=old_cols_exclude, inplace=True)
 
-    if not test_pkey(logger, old_df, new_df, pkey):
-        return
+    if mismatch_store is not None:
+        combined_df = compare_to_store(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, workers, mismatch_store, n_examples)
+        if combined_df is None:
+            return
+    elif workers>1:
+        from .compare_streaming import compare_in_partitions
+        combined_df = compare_in_partitions(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, workers)
+        if combined_df is None:
+            return
+    else:
+        key_index = None
+        if all(col in old_df.columns and col in new_df.columns for col in get_key_cols(pkey)):
+            key_index = KeyIndex(old_df, new_df, pkey)
+
+        if not test_pkey(logger, old_df, new_df, pkey, key_index):
+            return
 
-    test_joins(logger, old_df, new_df, pkey)
-    compare_columns(logger, old_df, new_df)
-    combined_df = compare_content(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances)
+        test_joins(logger, old_df, new_df, pkey, key_index)
+        compare_columns(logger, old_df, new_df)
+        combined_df = compare_content(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, key_index)
 
     if out_file is not None:
         store_results(logger, out_file)
@@ -194,6 +494,51 @@ def run_comparison(logger, old_df, new_df, pkey, old_cols_exclude, date_fields,
 
     return combined_df
 
+@traced
+def compare_to_store(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, workers, mismatch_store, n_examples=5):
+
+    # The checks of run_comparison with the mismatches going to mismatch_store. Returns a ComparisonResult,
+    # or None if the primary key tests fail.
+    key_cols = get_key_cols(pkey)
+
+    with MismatchStore(mismatch_store, mode='w') as store:
+        if workers>1:
+            from .compare_streaming import compare_in_partitions
+            stats = compare_in_partitions(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, workers, store=store)
+            if stats is None:
+                return
+        else:
+            key_index = None
+            if all(col in old_df.columns and col in new_df.columns for col in key_cols):
+                key_index = KeyIndex(old_df, new_df, pkey)
+
+            if not test_pkey(logger, old_df, new_df, pkey, key_index):
+                return
+
+            test_joins(logger, old_df, new_df, pkey, key_index)
+            compare_columns(logger, old_df, new_df)
+
+            stats = get_key_stats(old_df, new_df, key_index)
+            stats['compared'], stats['matches'] = compare_content_to_store(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, key_index, store)
+
+        store.finish()
+        logger.debug(f'Mismatches saved to {mismatch_store}')
+
+        return ComparisonResult.from_store(stats, key_cols, store, n_examples)
+
+def get_key_stats(old_df, new_df, key_index):
+
+    # The row and key counts, in the form the partitioned comparisons add up
+    return {
+        'old_rows': len(old_df),
+        'new_rows': len(new_df),
+        'old_keys': key_index.n_old_keys(),
+        'new_keys': key_index.n_new_keys(),
+        'old_only': key_index.n_old_only(),
+        'new_only': key_index.n_new_only(),
+    }
+
+@traced
 def map_values_prior_to_comparison(logger, df, value_mappings):
 
     logger.debug('Mapping values prior to doing the comparison')
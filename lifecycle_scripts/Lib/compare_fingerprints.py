@@ -0,0 +1,184 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .compare_datasets import compare_blocks, compare_columns, get_content_cols, get_key_cols, get_num_tolerance, log_join_results, log_match_rates, store_results, test_pkey, to_date_values
+from .logger import traced
+
+# Fingerprint mode for compare_datasets: every row is reduced to one 64-bit hash of its normalised values
+# (dates parsed, NAs filled and numbers bucketed by tolerance, as in the comparison), the two sides are compared
+# key -> hash, and the column by column comparison only runs on the rows whose hashes differ.
+# Two values in the same tolerance bucket are always within tolerance, so equal hashes mean the row matches.
+# Values within tolerance can still fall in neighbouring buckets, those rows just get compared in full.
+
+HASH_COL = 'row_hash'
+
+def normalise_col(values, col, date_fields, datetime_fields, day_first_in_dates, num_tolerances):
+
+    # Only depends on this side's dtype, so fingerprints saved from one run can be reused in the next
+    if col in date_fields or col in datetime_fields:
+        return to_date_values(values, day_first_in_dates, keep_time=col in datetime_fields).view('i8')
+
+    if values.dtype=='int64':
+        # kept as integers, as compare_blocks does, so large ints that differ don't end up in the same float.
+        # Ints in the same bucket of ceil(tolerance) differ by less than the tolerance (exact values up to 1).
+        bucket = max(int(np.ceil(get_num_tolerance(num_tolerances, col))), 1)
+        return values.to_numpy(dtype='int64')//bucket
+
+    if values.dtype=='float64':
+        tolerance = get_num_tolerance(num_tolerances, col)
+        values = values.to_numpy(dtype='float64')
+        values = np.where(np.isnan(values), 0.0, values)
+        return np.floor(values/tolerance)
+
+    if values.dtype==object:
+        values = values.to_numpy(dtype=object)
+        values = np.where(pd.isna(values), 'NA', values)
+        # tag anything that isn't a string with its type, so e.g. 1 and '1' don't hash the same (they don't compare equal)
+        if pd.api.types.infer_dtype(values, skipna=False)!='string':
+            values = np.array([v if isinstance(v, str) else f'{type(v).__name__}:{v!r}' for v in values], dtype=object)
+        return values
+
+    return values.to_numpy()
+
+def compute_fingerprints(df, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances):
+
+    # Returns the key and the row hash for each row. Columns are hashed in name order so both sides agree.
+    norm = pd.DataFrame({col: normalise_col(df[col], col, date_fields, datetime_fields, day_first_in_dates, num_tolerances) for col in sorted(cols, key=str)})
+    hashes = pd.util.hash_pandas_object(norm, index=False).to_numpy()
+
+    fingerprints = df[get_key_cols(pkey)].reset_index(drop=True)
+    fingerprints[HASH_COL] = hashes
+
+    return fingerprints
+
+def get_fingerprint_settings(pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances):
+
+    # Anything that changes the hashes. Saved fingerprints can only be reused if these are the same.
+    return {
+        'pkey': get_key_cols(pkey),
+        'cols': sorted([str(col) for col in cols]),
+        'date_fields': sorted(date_fields),
+        'datetime_fields': sorted(datetime_fields),
+        'day_first_in_dates': day_first_in_dates,
+        'num_tolerances': num_tolerances,
+    }
+
+@traced
+def save_fingerprints(logger, fingerprints, fname, columns, settings):
+
+    fingerprints.to_parquet(fname, index=False)
+
+    with open(fname + '.json', 'w') as f:
+        json.dump({'columns': [str(col) for col in columns], 'settings': settings}, f, indent=4)
+
+    logger.debug(f'Saved {len(fingerprints)} fingerprints to {fname}')
+
+@traced
+def load_fingerprints(logger, fname):
+
+    if not os.path.exists(fname) or not os.path.exists(fname + '.json'):
+        logger.warning(f'No saved fingerprints found at {fname}')
+        return None, None
+
+    with open(fname + '.json', 'r') as f:
+        meta = json.load(f)
+
+    fingerprints = pd.read_parquet(fname)
+    logger.debug(f'Read {len(fingerprints)} fingerprints from {fname}')
+
+    return fingerprints, meta
+
+@traced
+def run_comparison_fingerprint(logger, old_df, new_df, pkey, old_cols_exclude, date_fields, datetime_fields, day_first_in_dates=False, num_tolerances=0.0001, out_file=None,
+                               old_fingerprints=None, save_new_fingerprints=None):
+
+    # Same report as run_comparison, but only rows whose fingerprints differ are merged and compared column by column.
+    # old_fingerprints: fingerprints saved by a previous run (save_new_fingerprints) to use for the old side.
+    #   If old_df is None the old data isn't needed at all: the report then covers keys and changed rows only.
+    # Returns the combined frame for the changed rows (or the changed keys if old_df is None), None if the pkey tests fail.
+
+    logger.debug('Starting fingerprint comparison', True)
+
+    logger.debug('Numeral tolerances: ' + str(num_tolerances))
+
+    if old_df is not None:
+        old_df.drop(columns=old_cols_exclude, inplace=True)
+        old_columns = list(old_df.columns)
+
+    old_fp = None
+    if old_fingerprints is not None:
+        old_fp, meta = load_fingerprints(logger, old_fingerprints)
+        if old_fp is not None:
+            old_columns = meta['columns'] if old_df is None else old_columns
+            cols = get_content_cols(old_columns, new_df.columns, pkey)
+            if meta['settings']!=get_fingerprint_settings(pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances):
+                logger.warning(f'Saved fingerprints in {old_fingerprints} were made with different columns or settings, not using them')
+                old_fp = None
+
+    if old_fp is None and old_df is None:
+        logger.error('Either the old dataset or usable saved fingerprints are needed for a comparison')
+        return
+
+    # primary key tests, using the saved keys when the old data isn't there
+    key_cols = get_key_cols(pkey)
+    if old_df is not None:
+        if not test_pkey(logger, old_df, new_df, pkey):
+            return
+    elif any(col not in new_df.columns for col in key_cols):
+        logger.error(f'Primary key {pkey} not found in one or both of the datasets')
+        return
+    elif new_df.duplicated(subset=key_cols).any():
+        logger.error(f'Primary key {pkey} not unique in new dataset')
+        return
+    else:
+        logger.debug('Primary key tests pass')
+
+    cols = get_content_cols(old_columns, new_df.columns, pkey)
+    settings = get_fingerprint_settings(pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances)
+
+    if old_fp is None:
+        old_fp = compute_fingerprints(old_df, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances)
+    new_fp = compute_fingerprints(new_df, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances)
+
+    if save_new_fingerprints is not None:
+        save_fingerprints(logger, new_fp, save_new_fingerprints, new_df.columns, settings)
+
+    fp = old_fp.merge(new_fp, on=key_cols, suffixes=('_old', '_new'))
+    changed_keys = fp.loc[fp[f'{HASH_COL}_old']!=fp[f'{HASH_COL}_new'], key_cols].reset_index(drop=True)
+
+    logger.debug('Testing joins', True)
+    log_join_results(logger, len(old_fp), len(new_fp), len(old_fp) - len(fp), len(new_fp) - len(fp))
+
+    compare_columns(logger, pd.DataFrame(columns=old_columns), new_df.iloc[:0])
+
+    logger.debug('Comparing content', True)
+    logger.debug(f'Rows with a different fingerprint: {len(changed_keys)} of {len(fp)}')
+
+    if old_df is None:
+        # nothing to drill into without the old data, report the changed rows instead of per column rates
+        if len(changed_keys)>0:
+            logger.warning(f'Rows changed: {len(changed_keys)} ({100*round(len(changed_keys)/len(fp),4)}%)')
+        else:
+            logger.debug('Content matches exactly')
+        combined_df = changed_keys
+    else:
+        old_changed = old_df.merge(changed_keys, on=key_cols)
+        new_changed = new_df.merge(changed_keys, on=key_cols)
+        combined_df = old_changed.merge(new_changed, on=key_cols)
+
+        mismatches, _ = compare_blocks(combined_df, combined_df, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, suffixes=('_x', '_y'))
+        combined_df['diff'] = ~mismatches.any(axis=1)
+
+        # rows with the same fingerprint match on every column
+        n_matches = dict(zip(cols, len(fp) - mismatches.sum(axis=0)))
+        log_match_rates(logger, n_matches, len(fp))
+
+    if out_file is not None:
+        store_results(logger, out_file)
+
+    logger.debug('Completed comparison', True)
+
+    return combined_df
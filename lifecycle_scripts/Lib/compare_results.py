@@ -0,0 +1,238 @@
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Mismatches from a comparison kept on disk instead of in the merged frame. They're stored in long format,
+# one row per mismatching cell: the key column(s), the column name, the old and new values as text and the
+# absolute difference for numeric columns. A ComparisonResult holds the counts and a few examples per column,
+# everything else is read back from the store only when asked for.
+
+COLUMN_COL = 'column_name'
+OLD_COL = 'old_value'
+NEW_COL = 'new_value'
+DIFF_COL = 'abs_diff'
+TABLE_NAME = 'mismatches'
+
+def to_text(values):
+
+    # NAs are kept as nulls rather than written as 'nan'
+    text = values.astype(str).to_numpy(dtype=object)
+    text[values.isna().to_numpy()] = None
+
+    return text
+
+def to_long_format(df, key_cols, cols, mismatches, suffixes=('_x', '_y')):
+
+    # df is a merged frame and mismatches its (rows x cols) mismatch matrix from compare_blocks.
+    # Returns one row per mismatching cell, grouped by column.
+    col_idx, rows = np.nonzero(mismatches.T)
+
+    pieces = []
+    if len(rows)>0:
+        idx, starts = np.unique(col_idx, return_index=True)
+        for i, r in zip(idx, np.split(rows, starts[1:])):
+            old = df[cols[i] + suffixes[0]].iloc[r]
+            new = df[cols[i] + suffixes[1]].iloc[r]
+
+            piece = df[key_cols].iloc[r].reset_index(drop=True)
+            piece[COLUMN_COL] = str(cols[i])
+            piece[OLD_COL] = to_text(old)
+            piece[NEW_COL] = to_text(new)
+            if pd.api.types.is_numeric_dtype(old) and pd.api.types.is_numeric_dtype(new) and not pd.api.types.is_bool_dtype(old):
+                # NAs count as 0, as in the comparison
+                piece[DIFF_COL] = np.abs(old.to_numpy(dtype='float64', na_value=0.0) - new.to_numpy(dtype='float64', na_value=0.0))
+            else:
+                piece[DIFF_COL] = np.nan
+            pieces.append(piece)
+
+    if len(pieces)==0:
+        empty = df[key_cols].iloc[:0].reset_index(drop=True)
+        for col in [COLUMN_COL, OLD_COL, NEW_COL]:
+            empty[col] = pd.Series(dtype=object)
+        empty[DIFF_COL] = pd.Series(dtype='float64')
+        return empty
+
+    return pd.concat(pieces, ignore_index=True)
+
+def get_parquet_schema(long_df):
+
+    # One schema for every piece of a parquet store. Left to pandas, a piece whose values are all None gets a
+    # null type the other pieces can't be read back with. Key types come from the first piece (string if all null).
+    import pyarrow as pa
+
+    value_cols = [COLUMN_COL, OLD_COL, NEW_COL, DIFF_COL]
+    key_cols = [col for col in long_df.columns if col not in value_cols]
+    key_schema = pa.Schema.from_pandas(long_df[key_cols], preserve_index=False)
+    fields = [pa.field(field.name, pa.string() if pa.types.is_null(field.type) else field.type) for field in key_schema]
+
+    return pa.schema(fields + [pa.field(COLUMN_COL, pa.string()), pa.field(OLD_COL, pa.string()), pa.field(NEW_COL, pa.string()), pa.field(DIFF_COL, pa.float64())])
+
+class MismatchStore:
+
+    # A path ending in .parquet is written as a directory of parquet files (needs pyarrow), anything else
+    # as a SQLite database. mode='w' starts a new store, replacing whatever is at the path.
+
+    def __init__(self, path, mode='r'):
+
+        self.path = str(path)
+        self.is_parquet = self.path.endswith('.parquet')
+        self.n_pieces = 0
+        self.schema = None
+        self.conn = None
+
+        if mode=='w':
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+            if self.is_parquet:
+                os.makedirs(self.path)
+
+        if not self.is_parquet:
+            self.conn = sqlite3.connect(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def append(self, long_df):
+
+        if len(long_df)==0:
+            return
+
+        if self.is_parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.schema is None:
+                self.schema = get_parquet_schema(long_df)
+            table = pa.Table.from_pandas(long_df, schema=self.schema, preserve_index=False)
+            pq.write_table(table, os.path.join(self.path, f'part-{self.n_pieces:05d}.parquet'))
+        else:
+            long_df.to_sql(TABLE_NAME, self.conn, if_exists='append', index=False)
+            self.conn.commit()
+
+        self.n_pieces += 1
+
+    def finish(self):
+
+        # index the column name for the drill-down queries, once all the rows are in
+        if self.conn is not None and not self.is_empty():
+            self.conn.execute(f'create index if not exists ix_{TABLE_NAME}_{COLUMN_COL} on {TABLE_NAME} ({COLUMN_COL})')
+            self.conn.commit()
+
+    def is_empty(self):
+
+        if self.is_parquet:
+            return not os.path.isdir(self.path) or not any(fname.endswith('.parquet') for fname in os.listdir(self.path))
+
+        return self.conn.execute('select 1 from sqlite_master where type=\'table\' and name=?', (TABLE_NAME,)).fetchone() is None
+
+    def read(self, column=None, limit=None, largest_first=False):
+
+        # Mismatches for one column (or all of them), optionally the largest numeric differences first
+        if self.is_empty():
+            return pd.DataFrame(columns=[COLUMN_COL, OLD_COL, NEW_COL, DIFF_COL])
+
+        if self.is_parquet:
+            filters = [(COLUMN_COL, '==', str(column))] if column is not None else None
+            df = pd.read_parquet(self.path, filters=filters)
+            if largest_first:
+                df = df.sort_values(DIFF_COL, ascending=False, na_position='last', kind='stable')
+            if limit is not None:
+                df = df.head(limit)
+            return df.reset_index(drop=True)
+
+        sql = f'select * from {TABLE_NAME}'
+        params = []
+        if column is not None:
+            sql += f' where {COLUMN_COL}=?'
+            params.append(str(column))
+        if largest_first:
+            sql += f' order by {DIFF_COL} desc'
+        if limit is not None:
+            sql += ' limit ?'
+            params.append(int(limit))
+
+        return pd.read_sql(sql, self.conn, params=params)
+
+    def max_diffs(self):
+
+        # largest absolute difference per column (NaN for non-numeric columns)
+        if self.is_empty():
+            return {}
+
+        if self.is_parquet:
+            df = pd.read_parquet(self.path, columns=[COLUMN_COL, DIFF_COL])
+            return df.groupby(COLUMN_COL)[DIFF_COL].max().to_dict()
+
+        rows = self.conn.execute(f'select {COLUMN_COL}, max({DIFF_COL}) from {TABLE_NAME} group by {COLUMN_COL}').fetchall()
+
+        return {col: np.nan if diff is None else diff for col, diff in rows}
+
+class ComparisonResult:
+
+    # Returned instead of the merged frame when a comparison writes its mismatches to a store.
+    # stats: the overall counts (old_rows, new_rows, old_keys, new_keys, old_only, new_only, compared, matches)
+    # columns: one row per compared column with its matches, mismatches, match rate and largest numeric difference
+    # examples: the first n_examples mismatches of each mismatching column, largest differences first
+
+    def __init__(self, stats, key_cols, store_path, columns, examples):
+
+        self.stats = stats
+        self.key_cols = key_cols
+        self.store_path = store_path
+        self.columns = columns
+        self.examples = examples
+
+    @classmethod
+    def from_store(cls, stats, key_cols, store, n_examples=5):
+
+        n_rows = stats['compared']
+        max_diffs = store.max_diffs()
+
+        columns = pd.DataFrame({
+            'column': [str(col) for col in stats['matches']],
+            'matches': list(stats['matches'].values()),
+        })
+        columns['mismatches'] = n_rows - columns['matches']
+        columns['match_rate'] = columns['matches']/n_rows if n_rows>0 else np.nan
+        columns['max_abs_diff'] = columns['column'].map(max_diffs)
+
+        examples = {}
+        for col in columns.loc[columns['mismatches']>0, 'column']:
+            examples[col] = store.read(col, limit=n_examples, largest_first=True)
+
+        return cls(stats, key_cols, store.path, columns, examples)
+
+    @property
+    def match_rates(self):
+        return dict(zip(self.columns['column'], self.columns['match_rate']))
+
+    def mismatches(self, column=None, limit=None, largest_first=False):
+
+        # Reads the stored mismatches, for one column or all of them
+        with MismatchStore(self.store_path) as store:
+            return store.read(column, limit, largest_first)
+
+    def mismatched_keys(self):
+
+        df = self.mismatches()
+        if len(df)==0:
+            return pd.DataFrame(columns=self.key_cols)
+
+        return df[self.key_cols].drop_duplicates().reset_index(drop=True)
+
+    def __repr__(self):
+
+        n_cols = int((self.columns['mismatches']>0).sum())
+        return f'ComparisonResult({self.stats["compared"]} rows compared, {n_cols} columns with mismatches, store={self.store_path})'
@@ -0,0 +1,353 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+from .compare_datasets import KeyIndex, compare_blocks, compare_columns, get_content_cols, get_key_cols, get_key_stats, log_join_results, log_match_rates, merge_on_key_index, store_results
+from .compare_results import ComparisonResult, MismatchStore, to_long_format
+from .logger import traced
+
+# Streaming and parallel versions of compare_datasets.run_comparison.
+# Both sides are hash-partitioned on the primary key into spill files, so that every key lands in the same
+# partition on both sides. Each partition is then small enough to be compared with the in-memory functions,
+# either one after the other or in a process pool, and the per-partition counts add up to the same report
+# as a full comparison. Spill files are Arrow IPC files that the workers memory-map, so partitions are never
+# pickled between processes (pickle is only used as a fallback for columns Arrow can't hold).
+
+ROW_COL = '__row__'
+
+def read_chunks(logger, source, chunksize=500000):
+
+    # source can be a DataFrame, a path to a .csv, .txt (tab delimited) or .parquet file,
+    # or a (DataConnector, table_name) pair to stream from the database
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunksize):
+            yield source.iloc[start:start + chunksize]
+
+    elif isinstance(source, tuple):
+        data_conn, table_name = source
+        logger.debug(f'Streaming table {table_name} in chunks of {chunksize} rows')
+        yield from data_conn.read_data_iter(table_name, chunksize=chunksize)
+
+    else:
+        file_path = str(source)
+        logger.debug(f'Streaming file {file_path} in chunks of {chunksize} rows')
+        if file_path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+        elif file_path.endswith('.txt'):
+            yield from pd.read_csv(file_path, delimiter='\t', low_memory=False, chunksize=chunksize)
+        else:
+            yield from pd.read_csv(file_path, chunksize=chunksize)
+
+def get_partition_ids(keys, n_partitions):
+
+    # keys holds the key column(s). Hash on the string form of the key so that the same key ends up in the same
+    # partition on both sides even if one side was read as int and the other as float (e.g. a csv chunk with a missing value)
+    key_strs = {}
+    for col in keys.columns:
+        values = keys[col]
+        if values.dtype.kind == 'f' and (values.dropna() % 1 == 0).all():
+            values = values.astype('Int64')
+        key_strs[col] = values.astype(str)
+
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(key_strs), index=False).to_numpy()
+
+    return hashes % n_partitions
+
+def write_piece(df, path):
+
+    # path has no extension, the extension records how the piece was written
+    if pa is not None:
+        try:
+            feather.write_feather(df, path + '.arrow', compression='uncompressed')
+            return path + '.arrow'
+        except (pa.lib.ArrowException, ValueError, TypeError):
+            if os.path.exists(path + '.arrow'):
+                os.remove(path + '.arrow')
+
+    df.to_pickle(path + '.pkl')
+
+    return path + '.pkl'
+
+def read_piece(path):
+
+    if path.endswith('.arrow'):
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    return pd.read_pickle(path)
+
+def spill_partitions(chunks, label, pkey, work_dir, n_partitions, cols_exclude=[], add_row_numbers=False):
+
+    # Write each chunk's rows into one directory per partition. With add_row_numbers the original row
+    # position is kept in ROW_COL so results can be put back in the input order afterwards.
+    key_cols = get_key_cols(pkey)
+    columns = None
+    n_rows = 0
+
+    for i, chunk in enumerate(chunks):
+        if len(cols_exclude)>0:
+            chunk = chunk.drop(columns=cols_exclude)
+
+        if columns is None:
+            columns = list(chunk.columns)
+            if any(col not in columns for col in key_cols):
+                break
+
+        part_ids = get_partition_ids(chunk[key_cols], n_partitions)
+        for part_id, idx in pd.Series(part_ids).groupby(part_ids, sort=False).indices.items():
+            piece = chunk.iloc[idx].reset_index(drop=True)
+            if add_row_numbers:
+                piece[ROW_COL] = idx + n_rows
+            part_dir = os.path.join(work_dir, label, str(part_id))
+            os.makedirs(part_dir, exist_ok=True)
+            write_piece(piece, os.path.join(part_dir, str(i)))
+
+        n_rows += len(chunk)
+
+    return columns, n_rows
+
+def read_partition(work_dir, label, part_id, columns):
+
+    part_dir = os.path.join(work_dir, label, str(part_id))
+    if not os.path.exists(part_dir):
+        return pd.DataFrame(columns=columns)
+
+    fnames = sorted(os.listdir(part_dir), key=lambda fname: int(fname.split('.')[0]))
+    pieces = [read_piece(os.path.join(part_dir, fname)) for fname in fnames]
+
+    return pd.concat(pieces, ignore_index=True)
+
+def compare_partition(old_df, new_df, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances):
+
+    # All counts for one partition. Keys never span partitions, so they can simply be summed afterwards.
+    key_index = KeyIndex(old_df, new_df, pkey)
+
+    stats = get_key_stats(old_df, new_df, key_index)
+    stats['compared'] = 0
+    stats['matches'] = dict.fromkeys(cols, 0)
+
+    # the comparison is aborted if the key isn't unique, no point merging duplicates
+    if stats['old_rows']!=stats['old_keys'] or stats['new_rows']!=stats['new_keys']:
+        return stats, None, None
+
+    df = merge_on_key_index(old_df, new_df, key_index)
+    mismatches, _ = compare_blocks(df, df, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, suffixes=('_x', '_y'))
+
+    stats['compared'] = len(df)
+    stats['matches'] = {col: int(len(df) - n) for col, n in zip(cols, mismatches.sum(axis=0))}
+
+    return stats, df, mismatches
+
+def compare_partition_job(job):
+
+    # Runs in a worker process: reads one partition from the spill files, compares it and writes the merged
+    # rows to keep (all of them, only the mismatches, or with keep='long' just the mismatching cells in the
+    # long format of the mismatch store) back to the spill directory. Only the counts and the path of the
+    # output file are sent back to the parent.
+    work_dir, part_id, old_cols, new_cols, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, keep = job
+
+    old_df = read_partition(work_dir, 'old', part_id, old_cols)
+    new_df = read_partition(work_dir, 'new', part_id, new_cols)
+
+    stats, df, mismatches = compare_partition(old_df, new_df, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances)
+    if df is None:
+        return stats, None
+
+    if keep=='all':
+        df['diff'] = ~mismatches.any(axis=1)
+    elif keep=='long':
+        df = to_long_format(df, get_key_cols(pkey), cols, mismatches)
+    else:
+        df = df[mismatches.any(axis=1)].reset_index(drop=True)
+
+    if len(df)==0:
+        return stats, None
+
+    os.makedirs(os.path.join(work_dir, 'out'), exist_ok=True)
+
+    return stats, write_piece(df, os.path.join(work_dir, 'out', str(part_id)))
+
+def compare_partitions(work_dir, n_partitions, old_cols, new_cols, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, keep='mismatches', workers=1):
+
+    cols = get_content_cols(old_cols, new_cols, pkey)
+    jobs = [(work_dir, part_id, old_cols, new_cols, pkey, cols, date_fields, datetime_fields, day_first_in_dates, num_tolerances, keep) for part_id in range(n_partitions)]
+
+    if workers>1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(compare_partition_job, jobs))
+    else:
+        results = [compare_partition_job(job) for job in jobs]
+
+    total = {'matches': dict.fromkeys(cols, 0)}
+    out_files = []
+    for stats, part_file in results:
+        add_stats(total, stats)
+        if part_file is not None:
+            out_files.append(part_file)
+
+    return total, out_files
+
+def add_stats(total, stats):
+
+    for key, value in stats.items():
+        if key=='matches':
+            for col, n in value.items():
+                total['matches'][col] = total['matches'].get(col, 0) + n
+        else:
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+def report_pkey(logger, total, pkey):
+
+    if total['old_rows']!=total['old_keys']:
+        logger.error(f'Primary key {pkey} not unique in old dataset')
+        return False
+
+    if total['new_rows']!=total['new_keys']:
+        logger.error(f'Primary key {pkey} not unique in new dataset')
+        return False
+
+    logger.debug('Primary key tests pass')
+
+    return True
+
+def report_totals(logger, total, pkey, old_cols, new_cols):
+
+    # Logs the same messages, in the same order, as test_pkey, test_joins, compare_columns and compare_content
+    if not report_pkey(logger, total, pkey):
+        return False
+
+    logger.debug('Testing joins', True)
+    log_join_results(logger, total['old_keys'], total['new_keys'], total['old_only'], total['new_only'])
+
+    compare_columns(logger, pd.DataFrame(columns=old_cols), pd.DataFrame(columns=new_cols))
+
+    logger.debug('Comparing content', True)
+    log_match_rates(logger, total['matches'], total['compared'])
+
+    return True
+
+@traced
+def compare_in_partitions(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, workers, n_partitions=None, spill_dir=None, store=None):
+
+    # In-memory comparison spread over a process pool, used by run_comparison when workers>1.
+    # Logs the same report as the serial run and returns the same combined frame (rows in the same order),
+    # or None if the primary key tests fail. With a MismatchStore the mismatches are appended to the store
+    # and the overall counts returned instead of the frame.
+    if any(col not in old_df.columns or col not in new_df.columns for col in get_key_cols(pkey)):
+        logger.error(f'Primary key {pkey} not found in one or both of the datasets')
+        return
+
+    if n_partitions is None:
+        n_partitions = 4*workers
+
+    work_dir = tempfile.mkdtemp(dir=spill_dir)
+
+    try:
+        spill_partitions([old_df], 'old', pkey, work_dir, n_partitions, add_row_numbers=True)
+        spill_partitions([new_df], 'new', pkey, work_dir, n_partitions)
+
+        old_cols = list(old_df.columns)
+        new_cols = list(new_df.columns)
+        keep = 'all' if store is None else 'long'
+        total, out_files = compare_partitions(work_dir, n_partitions, old_cols + [ROW_COL], new_cols, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, keep=keep, workers=workers)
+
+        if not report_totals(logger, total, pkey, old_cols, new_cols):
+            return
+
+        if store is not None:
+            for part_file in out_files:
+                store.append(read_piece(part_file))
+            return total
+
+        if len(out_files)>0:
+            combined_df = pd.concat([read_piece(part_file) for part_file in out_files], ignore_index=True)
+            combined_df = combined_df.sort_values(ROW_COL, kind='stable').drop(columns=[ROW_COL]).reset_index(drop=True)
+        else:
+            combined_df = old_df.iloc[:0].merge(new_df.iloc[:0], on=get_key_cols(pkey))
+            combined_df['diff'] = pd.Series(dtype=bool)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return combined_df
+
+@traced
+def run_comparison_streaming(logger, old_source, new_source, pkey, old_cols_exclude, date_fields, datetime_fields, day_first_in_dates=False, num_tolerances=0.0001,
+                             out_file=None, mismatch_file=None, chunksize=500000, n_partitions=64, spill_dir=None, workers=1, mismatch_store=None, n_examples=5):
+
+    # Same checks and log messages as run_comparison, but memory is bounded by the chunk and partition sizes.
+    # Partitions are compared in a pool of processes when workers>1.
+    # Rows with at least one mismatching column are written to mismatch_file (csv) rather than returned.
+    # Returns a dict with the overall counts, or None if the primary key tests fail.
+    # With mismatch_store the mismatching cells are written to a MismatchStore instead (see compare_results)
+    # and a ComparisonResult is returned.
+
+    logger.debug('Starting streaming comparison', True)
+
+    logger.debug('Numeral tolerances: ' + str(num_tolerances))
+
+    work_dir = tempfile.mkdtemp(dir=spill_dir)
+
+    try:
+        logger.debug(f'Partitioning old dataset into {n_partitions} partitions', True)
+        old_cols, n_old = spill_partitions(read_chunks(logger, old_source, chunksize), 'old', pkey, work_dir, n_partitions, old_cols_exclude)
+        logger.debug(f'Partitioned {n_old} rows from old dataset')
+
+        logger.debug(f'Partitioning new dataset into {n_partitions} partitions', True)
+        new_cols, n_new = spill_partitions(read_chunks(logger, new_source, chunksize), 'new', pkey, work_dir, n_partitions)
+        logger.debug(f'Partitioned {n_new} rows from new dataset')
+
+        key_cols = get_key_cols(pkey)
+        if old_cols is None or new_cols is None or any(col not in old_cols or col not in new_cols for col in key_cols):
+            logger.error(f'Primary key {pkey} not found in one or both of the datasets')
+            return
+
+        keep = 'mismatches' if mismatch_store is None else 'long'
+        total, out_files = compare_partitions(work_dir, n_partitions, old_cols, new_cols, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, keep=keep, workers=workers)
+
+        if mismatch_store is not None:
+            with MismatchStore(mismatch_store, mode='w') as store:
+                for part_file in out_files:
+                    store.append(read_piece(part_file))
+                store.finish()
+        elif mismatch_file is not None:
+            if os.path.exists(mismatch_file):
+                os.remove(mismatch_file)
+            for part_file in out_files:
+                read_piece(part_file).to_csv(mismatch_file, index=False, mode='a', header=not os.path.exists(mismatch_file))
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not report_totals(logger, total, pkey, old_cols, new_cols):
+        return
+
+    if mismatch_store is not None:
+        logger.debug(f'Mismatches saved to {mismatch_store}')
+    elif mismatch_file is not None:
+        logger.debug(f'Mismatched rows saved to {mismatch_file}')
+
+    if out_file is not None:
+        store_results(logger, out_file)
+
+    logger.debug('Completed comparison', True)
+
+    if mismatch_store is not None:
+        with MismatchStore(mismatch_store) as store:
+            return ComparisonResult.from_store(total, key_cols, store, n_examples)
+
+    total['match_rates'] = {col: n/total['compared'] for col, n in total['matches'].items()} if total['compared']>0 else {}
+    total['mismatch_file'] = mismatch_file
+
+    return total
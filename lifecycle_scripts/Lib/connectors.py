@@ -1,60 +1,400 @@
-import pyodbc
+import functools
 import json
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import queue
 import shutil
+import tempfile
+import threading
+import time
+import uuid
 import os
 
+from .data_cache import DataCache
+from .file_utils import UMASK, atomic_path
+from .logger import traced
+from .read_spec import ReadSpec
+from .schemas import SchemaRegistry, apply_schema, get_read_dtypes, get_text_cols
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+class ConnectionPool:
+
+    # Open connections to one database, shared by every DataConnector (and thread) using that database.
+    # connect() is called to open a new connection when none is idle, with at most max_size open at once;
+    # after that acquire() waits for a connection to be released.
+
+    def __init__(self, connect, max_size=5):
+
+        self.connect = connect
+        self.max_size = max_size
+        self.idle = queue.LifoQueue()
+        self.n_open = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_open = self.n_open<self.max_size
+            if can_open:
+                self.n_open += 1
+
+        if not can_open:
+            return self.idle.get(timeout=timeout)
+
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.n_open -= 1
+            raise
+
+    def release(self, conn):
+
+        with self.lock:
+            closed = self.closed
+            if closed:
+                self.n_open -= 1
+        if closed:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+
+        # closes the idle connections, connections still in use are closed when they're released.
+        # get_pool opens a new pool for the database after this.
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.n_open -= 1
+
+# One pool per database (and connect function, when one is given), shared across DataConnector instances
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(key, connect, max_size=5):
+
+    with POOLS_LOCK:
+        if key not in POOLS or POOLS[key].closed:
+            POOLS[key] = ConnectionPool(connect, max_size)
+        return POOLS[key]
+
+def close_pools():
+
+    with POOLS_LOCK:
+        for pool in POOLS.values():
+            pool.close()
+        POOLS.clear()
+
+def get_connection_string(creds, database):
+
+    return 'DRIVER='+creds['driver']+';SERVER='+creds['server']+';DATABASE='+database+';UID='+creds['username_db']+';PWD='+creds['password_db']
+
+def connect_odbc(connection_string):
+
+    # imported here so reading local files doesn't need the ODBC driver installed
+    import pyodbc
+
+    return pyodbc.connect(connection_string)
+
+def build_query(table_name, cols=[], sql_filter='', trim_cols=[]):
+
+    # trim_cols are trimmed by the database (only when the columns are listed)
+    if len(cols)==0:
+        sql_query = f'select * from {table_name}'
+    else:
+        select = [f'LTRIM(RTRIM({col})) as {col}' if col in trim_cols else col for col in cols]
+        sql_query = 'select ' + ', '.join(select) + ' from ' + table_name
+
+    if sql_filter!='':
+        sql_query += ' ' + sql_filter
+
+    return sql_query
+
+def strip_strings(df, skip_cols=[]):
+
+    # Strip the text columns, as done for every read. Values that aren't strings are left as they are.
+    # Object columns holding only strings are stripped in one pass with Arrow when it's available.
+    if df is None:
+        return df
+
+    obj_cols = []
+    for col in df.columns:
+        if col in skip_cols or not pd.api.types.is_string_dtype(df[col].dtype):
+            continue
+        if df[col].dtype!=object:
+            # pandas string dtypes strip natively
+            df[col] = df[col].str.strip()
+        elif pa is not None and pd.api.types.infer_dtype(df[col], skipna=True)=='string':
+            obj_cols.append(col)
+        else:
+            df[col] = strip_mixed(df[col])
+
+    if len(obj_cols)>0:
+        values = df[obj_cols].to_numpy(dtype=object).ravel(order='F')
+        is_na = pd.isna(values)
+        stripped = pc.utf8_trim_whitespace(pa.array(values, type=pa.string(), from_pandas=True)).to_numpy(zero_copy_only=False)
+        stripped[is_na] = values[is_na]
+        stripped = stripped.reshape((len(df), len(obj_cols)), order='F')
+        for i, col in enumerate(obj_cols):
+            df[col] = stripped[:, i]
+
+    # categoricals only need their categories stripped, unless that makes two of them the same
+    for col in df.select_dtypes(['category']).columns:
+        categories = df[col].cat.categories
+        if pd.api.types.is_string_dtype(categories):
+            stripped = categories.str.strip()
+            if stripped.is_unique:
+                df[col] = df[col].cat.rename_categories(stripped)
+            else:
+                df[col] = df[col].astype(object).str.strip().astype('category')
+
+    return df
+
+def strip_mixed(values):
+
+    # strips the strings in a column of mixed types, keeping everything else
+    is_str = values.map(type)==str
+    if not is_str.any():
+        return values
+
+    return values.where(~is_str, values[is_str].str.strip())
+
+def write_partitioned(df, path, partition_cols, insert=False, compression='snappy'):
+
+    # Writes df as a parquet folder partitioned on partition_cols. Files are written to a temp folder and then
+    # moved into place one by one; without insert the old folder is swapped out only once the new one is complete.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    folder = os.path.dirname(path) or '.'
+    tmp_dir = tempfile.mkdtemp(dir=folder, prefix=f'.{os.path.basename(path)}.')
+    # mkdtemp creates it as 0700, it becomes the output folder
+    os.chmod(tmp_dir, 0o777 & ~UMASK)
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_to_dataset(table, tmp_dir, partition_cols=partition_cols, compression=compression,
+                            basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet')
+
+        if insert and os.path.isdir(path):
+            for root, _, fnames in os.walk(tmp_dir):
+                target_dir = os.path.join(path, os.path.relpath(root, tmp_dir))
+                os.makedirs(target_dir, exist_ok=True)
+                for fname in fnames:
+                    os.replace(os.path.join(root, fname), os.path.join(target_dir, fname))
+        else:
+            old_dir = None
+            if os.path.exists(path):
+                old_dir = tmp_dir + '.old'
+                os.replace(path, old_dir)
+            os.replace(tmp_dir, path)
+            if old_dir is not None:
+                shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
 class DataConnector:
-    def __init__(self, logger, credentials_path, local_data_dir_in, use_local_data,local_data_dir_out):
+
+    # database: the database connections are made to, pooled per connection string (server, database and
+    #   credentials) and shared across instances.
+    # connect: optional function returning a new DB-API connection, used instead of pyodbc (e.g. sqlite3 for testing).
+    #   Its connections are pooled separately, shared only by connectors given the same function.
+    #   Connections are used from several threads, so e.g. sqlite3 needs check_same_thread=False.
+    # cache_dir: folder to cache the cleaned results of read_data in (see data_cache), limited to cache_max_mb.
+    # schema_path: json registry of table dtypes applied by read_data (see schemas).
+    # sql_dialect: how row limits are written, 'mssql' (top n) or e.g. 'sqlite' (limit n).
+    def __init__(self, logger, credentials_path, local_data_dir_in, use_local_data,local_data_dir_out, database='arribasqlpool1', connect=None, pool_size=5,
+                 cache_dir=None, cache_max_mb=2048, schema_path=None, sql_dialect='mssql'):
 
         self.logger = logger
         self.creds_path = credentials_path
         self.local_data_dir_in = local_data_dir_in
         self.local_data_dir_out = local_data_dir_out
         self.use_local_data = use_local_data
-
-        with open(credentials_path, 'rb') as f:
-            self.creds = json.load(f)
+        self.database = database
+        self.sql_dialect = sql_dialect
+        self.pool = None
+        self._conn = None
+        self.cache = DataCache(cache_dir, cache_max_mb) if cache_dir is not None else None
+        self.schemas = SchemaRegistry(schema_path) if schema_path is not None else None
+
+        if credentials_path is not None:
+            with open(credentials_path, 'rb') as f:
+                self.creds = json.load(f)
+        else:
+            self.creds = {}
 
         if not use_local_data:
-            self.conn = self.create_sql_connection('arribasqlpool1')            
+            if connect is None:
+                # made from the connection string alone, the pool outlives this connector
+                connection_string = get_connection_string(self.creds, database)
+                pool_key = ('odbc', connection_string)
+                connect = functools.partial(connect_odbc, connection_string)
+            else:
+                pool_key = (self.creds.get('server'), database, connect)
+            self.pool = get_pool(pool_key, connect, pool_size)
 
+    @property
+    def conn(self):
 
-    def create_sql_connection(self, database):
+        # a connection held by this connector until close_connections, for callers that use it directly
+        if self._conn is None and self.pool is not None:
+            self._conn = self.pool.acquire()
 
-        self.logger.debug(f'Connecting to database {database}', True)
+        return self._conn
 
-        server = self.creds['server']
-        username = self.creds['username_db']
-        password = self.creds['password_db']
-        driver= self.creds['driver']
-        database = database
+    def create_sql_connection(self, database):
 
-        conn = pyodbc.connect('DRIVER='+driver+';SERVER='+server+';DATABASE='+database+';UID='+username+';PWD='+ password)
+        self.logger.debug(f'Connecting to database {database}', True)
 
-        return conn
+        return connect_odbc(get_connection_string(self.creds, database))
 
 
-    def close_connections(self):
+    def close_connections(self, close_pool=False):
 
+        # gives the connection back to the pool, which stays open for other connectors unless close_pool
         if not self.use_local_data:
 
             self.logger.debug('Closing db connections', True)
 
-            self.conn.close()
+            if self._conn is not None:
+                self.pool.release(self._conn)
+                self._conn = None
 
-    def read_data(self, table_name, schema='default', cols=[], csv=False, sql_filter='', keep_default_na=True):
+            if close_pool:
+                self.pool.close()
 
+    def get_file_path(self, table_name, csv=False):
+
+        if csv:
+            return f'{self.local_data_dir_in}/{table_name}.csv'
+
+        # a parquet copy of the table is used over the tab delimited file when there is one,
+        # unless the tab delimited file has been refreshed since the copy was made
+        parquet_path = f'{self.local_data_dir_in}/{table_name}.parquet'
+        txt_path = f'{self.local_data_dir_in}/{table_name}.txt'
+        if os.path.exists(parquet_path):
+            if not os.path.exists(txt_path) or os.path.getmtime(parquet_path)>=os.path.getmtime(txt_path):
+                return parquet_path
+            self.logger.debug(f'{txt_path} is newer than {parquet_path}, reading the tab delimited file')
+
+        return txt_path
+
+    def get_table_schema(self, table_name):
+
+        if self.schemas is None:
+            return None
+
+        return self.schemas.get(table_name)
+
+    def profile_schema(self, table_name, csv=False, dayfirst=False):
+
+        # Reads the table once without its schema and saves a starting schema for it to the registry
+        df = self.read_source(table_name, csv=csv)
+        if df is None:
+            return None
+
+        return self.schemas.profile(self.logger, table_name, df, dayfirst)
+
+    def get_cache_key(self, table_name, cols, csv, sql_filter, keep_default_na, cache_version, strip=True, spec=None):
+
+        # Files are keyed by their modification time and size. Tables can't be checked for changes cheaply,
+        # so they're only cached when the caller gives a cache_version (e.g. the ETL run date, or a row version
+        # from get_row_version). Returns None when the read can't be cached.
+        if self.use_local_data or csv:
+            file_path = self.get_file_path(table_name, csv)
+            if not os.path.exists(file_path):
+                return None
+            stat = os.stat(file_path)
+            return self.cache.make_key('file', os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, keep_default_na, strip, cols, spec.to_key() if spec is not None else None, self.get_table_schema(table_name))
+
+        if cache_version is None:
+            return None
+
+        return self.cache.make_key('sql', self.creds.get('server'), self.database, build_query(table_name, cols, sql_filter), cache_version, strip, spec.to_key() if spec is not None else None, self.get_table_schema(table_name))
+
+    def get_row_version(self, table_name, version_col):
+
+        # A cheap version for a table, to use as cache_version: the row count and the latest value of version_col
+        df = self.run_sql_query(f'select count(*), max({version_col}) from {table_name}')
+        if df is None:
+            return None
+
+        return tuple(df.iloc[0])
+
+    @traced
+    def read_data(self, table_name, schema='default', cols=[], csv=False, sql_filter='', keep_default_na=True, cache_version=None, strip=True, spec=None):
+
+        # With a cache_dir, results are cached (cleaned) between runs, see get_cache_key.
+        # strip=False keeps the whitespace around text values.
+        # spec: a ReadSpec of the columns, typed filters and row limit to read, used instead of cols and sql_filter
+        # and applied to files as well as tables.
+        cache_key = None
+        if self.cache is not None and schema=='default':
+            cache_key = self.get_cache_key(table_name, cols, csv, sql_filter, keep_default_na, cache_version, strip, spec)
+            if cache_key is not None:
+                df = self.cache.get(cache_key)
+                if df is not None:
+                    self.logger.debug(f'Read {len(df)} rows for {table_name} from cache')
+                    return df
+
+        df = self.read_source(table_name, schema, cols, csv, sql_filter, keep_default_na, self.get_table_schema(table_name), strip, spec)
+
+        if cache_key is not None and df is not None:
+            self.cache.put(cache_key, df)
+
+        return df
+
+    def read_source(self, table_name, schema='default', cols=[], csv=False, sql_filter='', keep_default_na=True, table_schema=None, strip=True, spec=None):
+
+        # table_schema: dtypes from the schema registry, applied while parsing files and after reading tables
+        # spec: a ReadSpec of the columns, filters and row limit to read (see read_spec)
         if self.use_local_data or csv:
             
+            file_path = self.get_file_path(table_name, csv)
+            if spec is None and len(cols)>0:
+                spec = ReadSpec(columns=cols)
+
             try:
-                if csv:
-                    file_path = f'{self.local_data_dir_in}/{table_name}.csv'
-                    df = pd.read_csv(file_path, keep_default_na=keep_default_na)
+                if spec is None and not file_path.endswith('.parquet'):
+                    if csv:
+                        df = pd.read_csv(file_path, keep_default_na=keep_default_na, dtype=get_read_dtypes(table_schema))
+                    else:
+                        df = pd.read_csv(file_path, delimiter='\t', low_memory=False, keep_default_na=keep_default_na, dtype=get_read_dtypes(table_schema))
+                    df = self.clean(df, table_schema, strip)
                 else:
-                    file_path = f'{self.local_data_dir_in}/{table_name}.txt'
-                    df = pd.read_csv(file_path, delimiter='\t', low_memory=False, keep_default_na=keep_default_na)
+                    # chunks are cleaned and filtered as they're read
+                    chunks = list(self.iter_file(file_path, keep_default_na, table_schema, strip, spec))
+                    df = pd.concat(chunks, ignore_index=True) if len(chunks)>0 else pd.DataFrame(columns=spec.columns if spec is not None else [])
 
                 self.logger.debug(f'Read {len(df)} rows from file {file_path}')
             except Exception as e:
@@ -63,45 +403,156 @@ class DataConnector:
 
         else:
 
-            if schema=='default':
-                conn = self.conn
-            else:
+            if schema!='default':
                 self.logger.error(f'Unknown schema specified to read from: {schema}')
                 return None
 
-            if len(cols)==0:
-                sql_query = f'select * from {table_name}'
-            else:
-                sql_query = 'select ' + cols.pop(0)                
-                for col in cols:
-                    sql_query += ', ' + col
-                sql_query += ' from ' + table_name
-
-            if sql_filter!='':
-                sql_query += ' ' + sql_filter
+            sql_query, params, trim_cols = self.get_sql_query(table_name, cols, sql_filter, table_schema, strip, spec)
 
             try:
-                df = pd.read_sql(sql_query, conn)
+                with self.pool.connection() as conn:
+                    df = pd.read_sql(sql_query, conn, params=params)
                 self.logger.debug(f'Read {len(df)} rows from table {table_name}')
             except Exception as e:
                 self.logger.error(f'Could not read table {table_name} in schema {schema}: {str(e)}')
                 df = None
-        
-        # do some cleanup before returning
-        df_obj = df.select_dtypes(['object'])
-        if df_obj is not None:
-            for col in df_obj.columns:
-                try:
-                    df[col] = df[col].str.strip()
-                except:
-                    pass
+
+            # do some cleanup before returning
+            df = self.clean(df, table_schema, strip, trim_cols)
 
         return df
 
+    def clean(self, df, table_schema, strip=True, trim_cols=[]):
+
+        if strip:
+            df = strip_strings(df, trim_cols)
+
+        return apply_schema(self.logger, df, table_schema)
+
+    def get_sql_query(self, table_name, cols, sql_filter, table_schema, strip=True, spec=None, params=None):
+
+        # Returns the query, its parameters and the columns the database trims.
+        # Text columns known from the schema are trimmed by the database when the columns are listed.
+        text_cols = get_text_cols(table_schema) if strip else []
+
+        if spec is not None:
+            trim_cols = [col for col in spec.columns if col in text_cols]
+            sql_query, params = spec.to_sql(table_name, trim_cols, self.sql_dialect)
+        else:
+            trim_cols = [col for col in cols if col in text_cols]
+            sql_query = build_query(table_name, cols, sql_filter, trim_cols)
+
+        return sql_query, params, trim_cols
+
+    def iter_file(self, file_path, keep_default_na=True, table_schema=None, strip=True, spec=None, chunksize=500000):
+
+        # Yields the file in cleaned chunks. With a spec only the columns needed are parsed, rows are filtered
+        # chunk by chunk and reading stops at the row limit. Parquet filters are pushed down to pyarrow,
+        # which skips the row groups that can't match.
+        usecols = spec.read_columns() if spec is not None else None
+
+        if file_path.endswith('.parquet'):
+            import pyarrow.dataset as ds
+            import pyarrow.parquet as pq
+            filters = spec.to_parquet_filters() if spec is not None else None
+            batches = ds.dataset(file_path, format='parquet').to_batches(columns=usecols, filter=pq.filters_to_expression(filters) if filters else None, batch_size=chunksize)
+            chunks = (batch.to_pandas() for batch in batches)
+        elif file_path.endswith('.csv'):
+            chunks = pd.read_csv(file_path, keep_default_na=keep_default_na, dtype=get_read_dtypes(table_schema), usecols=usecols, chunksize=chunksize)
+        else:
+            chunks = pd.read_csv(file_path, delimiter='\t', low_memory=False, keep_default_na=keep_default_na, dtype=get_read_dtypes(table_schema), usecols=usecols, chunksize=chunksize)
+
+        n_rows = 0
+        for chunk in chunks:
+            chunk = self.clean(chunk, table_schema, strip)
+            if spec is not None:
+                chunk = spec.filter_frame(chunk)
+                if spec.limit is not None:
+                    chunk = chunk.iloc[:spec.limit - n_rows]
+            n_rows += len(chunk)
+            yield chunk.reset_index(drop=True)
+            if spec is not None and spec.limit is not None and n_rows>=spec.limit:
+                break
+
+    @traced
+    def read_many(self, specs, max_workers=4):
+
+        # Reads several tables at once on a pool of threads, each read using its own pooled connection.
+        # specs: {name: dict of read_data arguments}, table_name defaults to the name.
+        # Returns {name: DataFrame} (None for the tables that couldn't be read).
+        if self.pool is not None:
+            max_workers = min(max_workers, self.pool.max_size)
+        max_workers = max(min(max_workers, len(specs)), 1)
+
+        self.logger.debug(f'Reading {len(specs)} tables with {max_workers} workers', True)
+
+        def read(name, spec):
+            spec = dict(spec or {})
+            table_name = spec.pop('table_name', name)
+            start = time.perf_counter()
+            df = self.read_data(table_name, **spec)
+            if df is not None:
+                self.logger.debug(f'Read {table_name} in {time.perf_counter() - start:.2f}s')
+            return df
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(read, name, spec) for name, spec in specs.items()}
+            data = {name: future.result() for name, future in futures.items()}
+
+        self.logger.debug(f'Read {len(specs)} tables in {time.perf_counter() - start:.2f}s')
+
+        return data
+
+    def read_data_iter(self, table_name, schema='default', cols=[], csv=False, sql_filter='', params=None, chunksize=100000, keep_default_na=True, strip=True, spec=None):
+
+        # Same as read_data, but yields the rows in DataFrames of up to chunksize rows, so large tables are never
+        # held in memory at once. From the database the rows are fetched from the cursor chunksize at a time.
+        # params are passed with the query, for ? placeholders in sql_filter.
+        table_schema = self.get_table_schema(table_name)
+
+        if self.use_local_data or csv:
+            file_path = self.get_file_path(table_name, csv)
+            if spec is None and len(cols)>0:
+                spec = ReadSpec(columns=cols)
+
+            n_rows = 0
+            for chunk in self.iter_file(file_path, keep_default_na, table_schema, strip, spec, chunksize):
+                n_rows += len(chunk)
+                yield chunk
+            self.logger.debug(f'Read {n_rows} rows from file {file_path}')
+            return
+
+        if schema!='default':
+            self.logger.error(f'Unknown schema specified to read from: {schema}')
+            return
+
+        sql_query, params, trim_cols = self.get_sql_query(table_name, cols, sql_filter, table_schema, strip, spec, params)
+
+        n_rows = 0
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql_query, params or ())
+                col_names = [col[0] for col in cursor.description]
+                while True:
+                    rows = cursor.fetchmany(chunksize)
+                    if len(rows)==0:
+                        break
+                    n_rows += len(rows)
+                    chunk = pd.DataFrame.from_records([tuple(row) for row in rows], columns=col_names)
+                    yield self.clean(chunk, table_schema, strip, trim_cols)
+            finally:
+                cursor.close()
+
+        self.logger.debug(f'Read {n_rows} rows from table {table_name}')
+
+    @traced
     def run_sql_query(self, sql_query):
 
         try:
-            df = pd.read_sql(sql_query, self.conn)
+            with self.pool.connection() as conn:
+                df = pd.read_sql(sql_query, conn)
             self.logger.debug(f'SQL query generated {len(df)} rows')
         except Exception as e:
             self.logger.error('Could not run SQL query provided: ' + str(e))
@@ -109,28 +560,110 @@ class DataConnector:
 
         return df
 
-    def write_data(self, df, fname, insert=False):
+    @traced
+    def execute_many(self, sql_query, rows, batch_size=10000, pre_sql=None):
 
+        # Runs a parameterised statement (e.g. an insert with ? placeholders) for every row in rows,
+        # batch_size rows per round trip. pyodbc sends each batch as one bulk parameter array (fast_executemany).
+        # pre_sql is run first, in the same transaction.
+        n_rows = 0
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                try:
+                    cursor.fast_executemany = True
+                except AttributeError:
+                    pass
+                if pre_sql is not None:
+                    cursor.execute(pre_sql)
+                for start in range(0, len(rows), batch_size):
+                    batch = rows[start:start + batch_size]
+                    cursor.executemany(sql_query, batch)
+                    n_rows += len(batch)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        return n_rows
+
+    def insert_rows(self, df, table_name, batch_size=10000):
+
+        # Appends the rows of df to an existing table
+        self.write_table(df, table_name, insert=True, batch_size=batch_size)
+
+    @traced
+    def write_data(self, df, fname, insert=False, fmt='csv', compression=None, partition_cols=None, batch_size=10000):
+
+        # Writes df to the output folder as fname.csv, .parquet or .feather, or with fmt='sql' to the table fname.
+        # insert appends to what's already there instead of replacing it.
+        # Files are written to a temp file and renamed into place, so readers never see a partly written file.
+        # compression: for parquet (default snappy) and feather (default lz4).
+        # partition_cols: parquet only, writes a folder of files partitioned on these columns.
+        if fmt=='sql':
+            return self.write_table(df, fname, insert, batch_size)
+
+        loc = self.get_output_path(fname, fmt)
         try:
-            loc = f'{self.local_data_dir_out}/{fname}.csv'
-            if insert:
-                df.to_csv(loc, index=False, mode='a', header=False)
+            if fmt=='csv':
+                with atomic_path(loc) as tmp_loc:
+                    if insert and os.path.exists(loc):
+                        shutil.copyfile(loc, tmp_loc)
+                        df.to_csv(tmp_loc, index=False, mode='a', header=False)
+                    else:
+                        df.to_csv(tmp_loc, index=False)
+
+            elif fmt=='parquet' and partition_cols is not None:
+                write_partitioned(df, loc, partition_cols, insert, compression or 'snappy')
+
+            elif fmt in ['parquet', 'feather']:
+                if insert and os.path.exists(loc):
+                    existing = pd.read_parquet(loc) if fmt=='parquet' else pd.read_feather(loc)
+                    df = pd.concat([existing, df], ignore_index=True)
+                with atomic_path(loc) as tmp_loc:
+                    if fmt=='parquet':
+                        df.to_parquet(tmp_loc, index=False, compression=compression or 'snappy')
+                    else:
+                        df.reset_index(drop=True).to_feather(tmp_loc, compression=compression or 'lz4')
+
             else:
-                df.to_csv(loc, index=False)
+                self.logger.error(f'Unknown format to write {fname} as: {fmt}')
+                return
+
             self.logger.debug(f'Saved {len(df)} rows to {loc}')
         except Exception as e:
             self.logger.error(f'Could not write data to {loc}: {str(e)}')
 
-    def file_exists(self, fname):
+    @traced
+    def write_table(self, df, table_name, insert=False, batch_size=10000):
+
+        # Bulk insert into an existing table (fast_executemany with pyodbc). Without insert the table is
+        # emptied first, in the same transaction.
+        sql_query = f'insert into {table_name} (' + ', '.join(df.columns) + ') values (' + ', '.join(['?']*len(df.columns)) + ')'
+        rows = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+        try:
+            n_rows = self.execute_many(sql_query, rows, batch_size, pre_sql=None if insert else f'delete from {table_name}')
+            self.logger.debug(f'Saved {n_rows} rows to table {table_name}')
+        except Exception as e:
+            self.logger.error(f'Could not write data to table {table_name}: {str(e)}')
+
+    def get_output_path(self, fname, fmt='csv'):
+
+        return f'{self.local_data_dir_out}/{fname}.{fmt}'
+
+    def file_exists(self, fname, fmt='csv'):
 
-        loc = f'{self.local_data_dir_out}/{fname}.csv'
+        loc = self.get_output_path(fname, fmt)
         path = Path(loc)
         return path.exists()
 
-    def copy_file(self, filename, dst):
+    def copy_file(self, filename, dst, fmt='csv'):
 
         src = self.local_data_dir_out
-        fname = f'{filename}.csv'
+        fname = f'{filename}.{fmt}'
         try:
             shutil.copy(os.path.join(src, fname), os.path.join(dst, fname))
             self.logger.debug(f'Copied file {fname} to {dst}')
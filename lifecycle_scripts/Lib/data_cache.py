@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+
+from .file_utils import atomic_path
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# On-disk cache of cleaned tables for DataConnector.read_data. Each table is saved as a Feather file named by a
+# hash of everything that decides its content (source, columns, filter and the source's mtime or row version),
+# so a changed source simply gets a new entry. Files are touched when read and the least recently used are
+# removed once the cache is over max_mb. Pickle is used for tables Arrow can't hold, or without pyarrow.
+# read_many uses the cache from several threads: eviction and touching entries are done under a lock, and an
+# entry removed in the meantime (by another thread or process) counts as a miss.
+
+def remove_file(path):
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class DataCache:
+
+    def __init__(self, cache_dir, max_mb=2048):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb*2**20
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, *parts):
+
+        return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+
+        for ext in ['.arrow', '.pkl']:
+            path = os.path.join(self.cache_dir, key + ext)
+            if not os.path.exists(path):
+                continue
+            try:
+                df = feather.read_feather(path) if ext=='.arrow' else pd.read_pickle(path)
+            except FileNotFoundError:
+                # evicted since the check
+                continue
+            except Exception:
+                # unreadable (e.g. written by another version), read from the source again
+                with self.lock:
+                    remove_file(path)
+                return None
+            with self.lock:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+            return df
+
+        return None
+
+    def put(self, key, df):
+
+        # written to a temp file first so a failed or concurrent write never leaves a partial entry
+        written = False
+        if pa is not None:
+            try:
+                with atomic_path(os.path.join(self.cache_dir, key + '.arrow')) as tmp_path:
+                    feather.write_feather(df, tmp_path)
+                written = True
+            except (pa.lib.ArrowException, ValueError, TypeError):
+                pass
+        if not written:
+            with atomic_path(os.path.join(self.cache_dir, key + '.pkl')) as tmp_path:
+                df.to_pickle(tmp_path)
+
+        self.evict()
+
+    def evict(self):
+
+        with self.lock:
+            entries = []
+            for fname in os.listdir(self.cache_dir):
+                if fname.endswith('.arrow') or fname.endswith('.pkl'):
+                    try:
+                        stat = os.stat(os.path.join(self.cache_dir, fname))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, fname))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, fname in sorted(entries):
+                if total<=self.max_bytes:
+                    break
+                remove_file(os.path.join(self.cache_dir, fname))
+                total -= size
+
+    def clear(self):
+
+        with self.lock:
+            for fname in os.listdir(self.cache_dir):
+                if fname.endswith('.arrow') or fname.endswith('.pkl'):
+                    remove_file(os.path.join(self.cache_dir, fname))
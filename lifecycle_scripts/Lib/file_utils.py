@@ -0,0 +1,24 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Read once: os.umask can only be read by setting it, which isn't safe to do while other threads create files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+@contextmanager
+def atomic_path(path):
+
+    # Yields a temp path next to path, renamed to path once the block completes (removed if it fails).
+    # mkstemp creates the file as 0600, so it gets the mode a plain open() would have given it first.
+    folder, fname = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder or '.', prefix=f'.{fname}.', suffix='.tmp')
+    os.close(fd)
+
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -44,10 +44,22 @@
 
 
 # below will return AU sydney time
+import functools
+import json
+import os
+import sys
+import threading
 import time
+from collections import deque
 from datetime import datetime
 from zoneinfo import ZoneInfo  # ✅ 新增：用于时区处理
 
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -62,34 +74,294 @@ class bcolors:
     RESET = '\033[0m'
 
 
+LEVELS = {'DEBUG': 10, 'WARN': 30, 'ERROR': 40}
+
+
+class JsonLinesSink:
+    # Appends log records as json lines to path through a buffered file. Once the file is over max_mb it's
+    # renamed to path.1 (path.1 to path.2 and so on, keeping backup_count files) and a new one is started.
+    def __init__(self, path, max_mb=50, backup_count=5):
+        self.path = path
+        self.max_bytes = max_mb*2**20
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.f = open(path, 'a', encoding='utf-8')
+        self.size = self.f.tell()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            if self.f is None:
+                return
+            if self.max_bytes>0 and self.size + len(line)>self.max_bytes and self.size>0:
+                self.rotate()
+            self.f.write(line)
+            self.size += len(line)
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backup_count>0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+    def flush(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.flush()
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def get_peak_rss():
+
+    # Peak resident memory of the process so far in bytes, None where it can't be read
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform=='darwin' else peak*1024
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+
+def count_rows(values):
+
+    # Total rows of the DataFrames among values (one level into lists, tuples and dicts), None if there are none
+    n_rows = None
+    for value in values:
+        if isinstance(value, dict):
+            value = list(value.values())
+        items = value if isinstance(value, (list, tuple)) else [value]
+        for item in items:
+            if hasattr(item, 'columns') and hasattr(item, 'index'):
+                n_rows = (n_rows or 0) + len(item)
+
+    return n_rows
+
+
+class Span:
+    # Times one stage: wall and CPU time, the growth of the process's peak memory and the rows in and out.
+    # Used as a context manager (set span.rows_out inside the block), or as a decorator through Logger.span.
+    # CPU time and memory are for the whole process, so they include other threads running at the same time.
+    def __init__(self, logger, name, rows_in=None):
+        self.logger = logger
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        stack = self.logger._span_stack()
+        self.depth = len(stack)
+        stack.append(self.name)
+        self.peak_rss = get_peak_rss()
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        peak_rss = get_peak_rss()
+        self.logger._span_stack().pop()
+
+        self.logger.spans.append({
+            'name': self.name,
+            'start': self.start - self.logger.start_time,
+            'wall': wall,
+            'cpu': cpu,
+            'rss_delta_mb': None if peak_rss is None else (peak_rss - self.peak_rss)/2**20,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'depth': self.depth,
+            'thread': threading.get_ident(),
+            'error': None if exc_type is None else exc_type.__name__,
+        })
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Span(self.logger, self.name, count_rows(list(args) + list(kwargs.values()))) as span:
+                result = fn(*args, **kwargs)
+                span.rows_out = count_rows([result])
+                return result
+        return wrapper
+
+
+def traced(fn=None, name=None):
+
+    # Decorator recording a span on every call of a function that takes the logger as its first argument, or a
+    # method of an object with a logger attribute. DataFrame arguments are counted as the rows in and a
+    # DataFrame result as the rows out. name defaults to the function's qualified name.
+    if fn is None:
+        return lambda fn: traced(fn, name)
+
+    span_name = name or fn.__qualname__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        logger = None
+        if len(args)>0:
+            logger = args[0] if hasattr(args[0], 'spans') else getattr(args[0], 'logger', None)
+        if not hasattr(logger, 'spans'):
+            return fn(*args, **kwargs)
+
+        with Span(logger, span_name, count_rows(list(args[1:]) + list(kwargs.values()))) as span:
+            result = fn(*args, **kwargs)
+            span.rows_out = count_rows([result])
+            return result
+
+    return wrapper
+
+
 class Logger:
-    def __init__(self):
-        self.logs = []
+    # level: lowest severity kept, 'DEBUG', 'WARN' or 'ERROR'. Messages below it are dropped straight away.
+    # max_logs: the most recent records kept in self.logs (for store_results), None for all of them.
+    # log_file: optional json lines file every record is also written to, rotated at max_file_mb.
+    # console: print the records (coloured) as well.
+    def __init__(self, level='DEBUG', max_logs=100000, log_file=None, max_file_mb=50, backup_count=5, console=True, tz='Australia/Sydney'):
+        self.logs = deque(maxlen=max_logs)
         self.warning_detected = False
         self.error_detected = False
 
+        self.level = LEVELS[level]
+        self.console = console
+        self.tz = ZoneInfo(tz)
+        self.sink = JsonLinesSink(log_file, max_file_mb, backup_count) if log_file else None
+
+        # timestamps only have seconds, so each one is formatted once
+        self._second = None
+        self._timestamp = None
+
+        # timed stages, see span and traced
+        self.spans = deque(maxlen=max_logs)
+        self.start_time = time.perf_counter()
+        self._local = threading.local()
+
     def debug(self, msg, header=False):
+        if self.level>LEVELS['DEBUG']:
+            return
         if header:
             self._write_log('DEBUG', msg, bcolors.HEADER)
         else:
             self._write_log('DEBUG', msg)
 
     def warning(self, msg):
-        self._write_log('WARN', msg, bcolors.WARNING)
         self.warning_detected = True
+        if self.level<=LEVELS['WARN']:
+            self._write_log('WARN', msg, bcolors.WARNING)
 
     def error(self, msg):
-        self._write_log('ERROR', msg, bcolors.FAIL)
         self.error_detected = True
+        self._write_log('ERROR', msg, bcolors.FAIL)
+        # errors are written out straight away in case the run doesn't get any further
+        self.flush()
 
-    def _write_log(self, level, msg, clr=bcolors.OKGREEN):
+    def is_enabled(self, level):
+        # for callers building expensive messages, e.g. if logger.is_enabled('DEBUG'): logger.debug(...)
+        return self.level<=LEVELS[level]
+
+    def get_timestamp(self):
         # ✅ 使用澳大利亚悉尼时间
-        timestamp = datetime.now(
-            ZoneInfo("Australia/Sydney")).strftime('%Y-%m-%d %H:%M:%S')
-        print(f'{clr} {timestamp} {level} {msg} {bcolors.RESET}')
+        second = int(time.time())
+        if second!=self._second:
+            self._timestamp = datetime.fromtimestamp(second, self.tz).strftime('%Y-%m-%d %H:%M:%S')
+            self._second = second
+        return self._timestamp
 
-        self.logs.append({
+    def _write_log(self, level, msg, clr=bcolors.OKGREEN):
+        timestamp = self.get_timestamp()
+        if self.console:
+            # sys.stdout is looked up on every call so redirect_stdout still works
+            sys.stdout.write(f'{clr} {timestamp} {level} {msg} {bcolors.RESET}\n')
+
+        record = {
             'timestamp': timestamp,
             'severity': level,
             'message': msg
-        })
+        }
+        self.logs.append(record)
+        if self.sink is not None:
+            self.sink.write(record)
+
+    def flush(self):
+        if self.console:
+            sys.stdout.flush()
+        if self.sink is not None:
+            self.sink.flush()
+
+    def close(self):
+        self.flush()
+        if self.sink is not None:
+            self.sink.close()
+
+    def span(self, name, rows_in=None):
+        # with logger.span('merge', len(df)) as span: ... span.rows_out = len(result)
+        # or as a decorator: @logger.span('merge')
+        return Span(self, name, rows_in)
+
+    def _span_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def get_span_summary(self):
+
+        # One row per stage name: calls, total wall and CPU seconds, largest memory growth and total rows
+        summary = {}
+        for span in self.spans:
+            row = summary.setdefault(span['name'], {'name': span['name'], 'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                    'rss_delta_mb': None, 'rows_in': None, 'rows_out': None})
+            row['calls'] += 1
+            row['wall'] += span['wall']
+            row['cpu'] += span['cpu']
+            for key in ['rows_in', 'rows_out']:
+                if span[key] is not None:
+                    row[key] = (row[key] or 0) + span[key]
+            if span['rss_delta_mb'] is not None:
+                row['rss_delta_mb'] = max(row['rss_delta_mb'] or 0.0, span['rss_delta_mb'])
+
+        return sorted(summary.values(), key=lambda row: -row['wall'])
+
+    def log_spans(self):
+
+        def fmt(value, spec):
+            return '-' if value is None else format(value, spec)
+
+        self.debug('Stage timings', True)
+        self.debug(f'{"stage":<40} {"calls":>6} {"wall s":>9} {"cpu s":>9} {"peak +MB":>9} {"rows in":>11} {"rows out":>11}')
+        for row in self.get_span_summary():
+            self.debug(f'{row["name"]:<40} {row["calls"]:>6} {row["wall"]:>9.3f} {row["cpu"]:>9.3f} {fmt(row["rss_delta_mb"], ">9.1f")} '
+                       f'{fmt(row["rows_in"], ">11")} {fmt(row["rows_out"], ">11")}')
+
+    def write_trace(self, path):
+
+        # Chrome trace format, open it in chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            args = {key: span[key] for key in ['cpu', 'rss_delta_mb', 'rows_in', 'rows_out', 'error'] if span[key] is not None}
+            events.append({'name': span['name'], 'cat': 'stage', 'ph': 'X', 'ts': span['start']*1e6, 'dur': span['wall']*1e6,
+                           'pid': pid, 'tid': span['thread'], 'args': args})
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        self.debug(f'Saved a trace of {len(events)} spans to {path}')
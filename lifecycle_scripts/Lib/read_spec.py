@@ -0,0 +1,126 @@
+import pandas as pd
+
+# What to read from a table: the columns, typed filters and a row limit. DataConnector compiles a ReadSpec to
+# parameterised SQL for the database, and to usecols plus filtering while reading for local files (row group
+# pruning for parquet), so only the rows and columns asked for are loaded.
+#
+#   ReadSpec(columns=['ClaimNo', 'BillDate'], filters=[('BillType', '==', 1), ('BillDate', '>=', '2024-01-01'),
+#            ('TemplateName', 'in', ['Assessment', 'Report'])], limit=1000)
+#
+# Filters are (column, op, value) with op one of ==, !=, <, <=, >, >=, in, not in, between (value a (low, high) pair).
+# All filters must hold for a row to be read. The database and parquet files are filtered on the values as stored,
+# csv and txt files after the values are cleaned (stripped and typed by the schema).
+
+SQL_OPS = {'==': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+LIST_OPS = ['in', 'not in']
+
+class ReadSpec:
+
+    def __init__(self, columns=None, filters=None, limit=None):
+
+        self.columns = list(columns) if columns else []
+        self.filters = [tuple(f) for f in filters] if filters else []
+        self.limit = limit
+
+        for col, op, value in self.filters:
+            if op not in SQL_OPS and op not in LIST_OPS and op!='between':
+                raise ValueError(f'Unknown filter operator {op} for column {col}')
+            if op in LIST_OPS and len(value)==0:
+                raise ValueError(f'Empty list for filter {op} on column {col}')
+            if op=='between' and len(value)!=2:
+                raise ValueError(f'Filter between on column {col} needs a (low, high) pair')
+
+    def __repr__(self):
+        return f'ReadSpec(columns={self.columns}, filters={self.filters}, limit={self.limit})'
+
+    def to_key(self):
+        # for cache keys
+        return [self.columns, [[col, op, value] for col, op, value in self.filters], self.limit]
+
+    def read_columns(self):
+
+        # columns needed from the source: the ones asked for plus the ones filtered on (None for all)
+        if len(self.columns)==0:
+            return None
+
+        return self.columns + [col for col, _, _ in self.filters if col not in self.columns]
+
+    def to_sql(self, table_name, trim_cols=[], dialect='mssql'):
+
+        # Returns the query with ? placeholders and its parameters. dialect decides how the limit is written:
+        # 'mssql' (select top n) or anything else (limit n, e.g. sqlite or duckdb).
+        select = [f'LTRIM(RTRIM({col})) as {col}' if col in trim_cols else col for col in self.columns]
+        sql_query = 'select '
+        if self.limit is not None and dialect=='mssql':
+            sql_query += f'top {int(self.limit)} '
+        sql_query += (', '.join(select) if len(select)>0 else '*') + f' from {table_name}'
+
+        conditions = []
+        params = []
+        for col, op, value in self.filters:
+            if op in SQL_OPS:
+                conditions.append(f'{col} {SQL_OPS[op]} ?')
+                params.append(value)
+            elif op in LIST_OPS:
+                conditions.append(f'{col} {op} (' + ', '.join(['?']*len(value)) + ')')
+                params.extend(value)
+            else:
+                conditions.append(f'{col} between ? and ?')
+                params.extend(value)
+
+        if len(conditions)>0:
+            sql_query += ' where ' + ' and '.join(conditions)
+
+        if self.limit is not None and dialect!='mssql':
+            sql_query += f' limit {int(self.limit)}'
+
+        return sql_query, params
+
+    def to_parquet_filters(self):
+
+        # pyarrow filters, used to skip row groups and filter rows while reading parquet files
+        if len(self.filters)==0:
+            return None
+
+        filters = []
+        for col, op, value in self.filters:
+            if op=='between':
+                filters.append((col, '>=', value[0]))
+                filters.append((col, '<=', value[1]))
+            else:
+                filters.append((col, op, list(value) if op in LIST_OPS else value))
+
+        return filters
+
+    def filter_frame(self, df):
+
+        # Keeps the rows of df matching every filter, and only the columns asked for
+        mask = pd.Series(True, index=df.index)
+        for col, op, value in self.filters:
+            values = df[col]
+            if op=='==':
+                mask &= values==value
+            elif op=='!=':
+                # nulls never match, as in SQL
+                mask &= values.notna() & (values!=value)
+            elif op=='<':
+                mask &= values<value
+            elif op=='<=':
+                mask &= values<=value
+            elif op=='>':
+                mask &= values>value
+            elif op=='>=':
+                mask &= values>=value
+            elif op=='in':
+                mask &= values.isin(value)
+            elif op=='not in':
+                mask &= values.notna() & ~values.isin(value)
+            else:
+                mask &= (values>=value[0]) & (values<=value[1])
+
+        if not mask.all():
+            df = df[mask]
+        if len(self.columns)>0:
+            df = df[self.columns]
+
+        return df
@@ -0,0 +1,150 @@
+import json
+import os
+
+import pandas as pd
+
+from .logger import traced
+
+# Per-table dtype schemas, so tables are read with known types instead of pandas inferring them on every load.
+# The registry is a json file of {table_name: schema}, each schema being
+#   {"dtypes": {col: dtype}, "categoricals": [col, ...], "dates": {col: format or null}, "coerce_dates": [col, ...]}
+# dtypes and categoricals are applied while parsing files, dates are parsed straight after reading with
+# the given format (null to let pandas infer it). A value that doesn't parse raises, as pd.to_datetime does,
+# except in the coerce_dates columns where it becomes NaT (with a warning of how many did).
+# Columns missing from a table are ignored.
+
+class SchemaRegistry:
+
+    def __init__(self, path):
+
+        self.path = path
+        self.schemas = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.schemas = json.load(f)
+
+    def get(self, table_name):
+
+        return self.schemas.get(table_name)
+
+    def set(self, table_name, table_schema):
+
+        self.schemas[table_name] = table_schema
+
+    def save(self):
+
+        with open(self.path, 'w') as f:
+            json.dump(self.schemas, f, indent=4)
+
+    def profile(self, logger, table_name, df, dayfirst=False):
+
+        # Adds a starting schema for the table from one pass over df, to be reviewed and edited by hand
+        table_schema = profile_schema(df, dayfirst)
+        self.set(table_name, table_schema)
+        self.save()
+
+        logger.debug(f'Saved a schema for {table_name} to {self.path}: {len(table_schema["dtypes"])} typed, '
+                     f'{len(table_schema["categoricals"])} categorical and {len(table_schema["dates"])} date columns')
+
+        return table_schema
+
+def get_read_dtypes(table_schema):
+
+    # dtype argument for read_csv. Date columns are read as text and parsed in apply_schema.
+    if table_schema is None:
+        return None
+
+    dtypes = dict(table_schema.get('dtypes', {}))
+    for col in table_schema.get('categoricals', []):
+        dtypes[col] = 'category'
+
+    return dtypes
+
+def get_text_cols(table_schema):
+
+    # The columns declared as text, categoricals included
+    if table_schema is None:
+        return []
+
+    text_cols = [col for col, dtype in table_schema.get('dtypes', {}).items() if dtype in ['str', 'object', 'string']]
+
+    return text_cols + list(table_schema.get('categoricals', []))
+
+@traced
+def apply_schema(logger, df, table_schema):
+
+    # Parses the date columns and casts any column not already read with its declared type (e.g. from SQL)
+    if df is None or table_schema is None:
+        return df
+
+    coerce_dates = table_schema.get('coerce_dates', [])
+    for col, fmt in table_schema.get('dates', {}).items():
+        if col not in df.columns or pd.api.types.is_datetime64_any_dtype(df[col]):
+            continue
+
+        if col in coerce_dates:
+            dates = pd.to_datetime(df[col], format=fmt, errors='coerce')
+            n_coerced = int((dates.isna() & df[col].notna()).sum())
+            if n_coerced>0:
+                logger.warning(f'{n_coerced} values of column {col} could not be parsed as dates and were set to NaT')
+            df[col] = dates
+        else:
+            try:
+                df[col] = pd.to_datetime(df[col], format=fmt)
+            except (ValueError, TypeError) as e:
+                logger.error(f'Could not parse column {col} as dates: {str(e)}')
+                raise
+
+    for col, dtype in get_read_dtypes(table_schema).items():
+        if col not in df.columns or str(df[col].dtype)==dtype:
+            continue
+
+        if dtype=='str':
+            # text columns are fine as they are, and NAs must not become 'nan'
+            if not pd.api.types.is_string_dtype(df[col]):
+                df[col] = df[col].astype(str).where(df[col].notna())
+        else:
+            try:
+                df[col] = df[col].astype(dtype)
+            except (ValueError, TypeError) as e:
+                logger.warning(f'Could not convert column {col} to {dtype}: {str(e)}')
+
+    return df
+
+def profile_schema(df, dayfirst=False, max_categories=1000, max_category_ratio=0.5):
+
+    # Numeric and boolean columns keep their inferred type, text columns become dates when a single format
+    # parses them, categoricals when they have few distinct values, and str otherwise
+    from .compare_datasets import infer_date_format
+
+    table_schema = {'dtypes': {}, 'categoricals': [], 'dates': {}}
+
+    for col in df.columns:
+        values = df[col]
+
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            table_schema['dtypes'][col] = str(values.dtype)
+            continue
+
+        if pd.api.types.is_datetime64_any_dtype(values):
+            table_schema['dates'][col] = None
+            continue
+
+        non_null = values.dropna()
+        if len(non_null)==0:
+            table_schema['dtypes'][col] = 'str'
+            continue
+
+        fmt = infer_date_format(non_null.to_numpy(dtype=object), dayfirst)
+        if fmt is not None and pd.to_datetime(non_null, format=fmt, errors='coerce').notna().all():
+            table_schema['dates'][col] = fmt
+            continue
+
+        n_unique = non_null.nunique()
+        if n_unique<=max_categories and n_unique<=max_category_ratio*len(non_null):
+            table_schema['categoricals'].append(col)
+        else:
+            table_schema['dtypes'][col] = 'str'
+
+    return table_schema
@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from .file_utils import atomic_path
+
+# State kept between runs of an incremental job: named tables saved as parquet files in one folder, and a json
+# of small values (watermarks, the settings the state was built with). Every file is written to a temp file and
+# renamed into place, so a run that fails part way leaves the previous state readable.
+
+class StateStore:
+
+    def __init__(self, path):
+
+        self.path = path
+        self.values_path = os.path.join(path, 'state.json')
+        os.makedirs(path, exist_ok=True)
+
+        self.values = {}
+        if os.path.exists(self.values_path):
+            with open(self.values_path, 'r') as f:
+                self.values = json.load(f)
+
+    def get_table_path(self, name):
+
+        return os.path.join(self.path, f'{name}.parquet')
+
+    def load(self, name):
+
+        # None if the table hasn't been saved yet
+        table_path = self.get_table_path(name)
+        if not os.path.exists(table_path):
+            return None
+
+        return pd.read_parquet(table_path)
+
+    def save(self, name, df):
+
+        with atomic_path(self.get_table_path(name)) as tmp_path:
+            df.to_parquet(tmp_path, index=False)
+
+    def get(self, key, default=None):
+
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+
+        # kept in memory until save_values
+        self.values[key] = value
+
+    def save_values(self):
+
+        with atomic_path(self.values_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.values, f, indent=4, default=str)
+
+    def clear(self):
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+        self.values = {}
@@ -1,9 +1,10 @@
 import pandas as pd
 
-from libs.logger import Logger
+from .logger import traced
 
 # General utils
 
+@traced
 def no_dups(logger, df, pkey):
 
     if pkey not in df.columns:
@@ -15,6 +16,7 @@ def no_dups(logger, df, pkey):
 
 # Method to add a new column to a CSV file.
 # Include a 'pos' parameter to add the column at a specified position (first column is position 0)
+@traced
 def add_column_to_csv(logger, fname, col_name, pos=-1):
 
     logger.debug(f'Adding column {col_name} to csv file {fname}')
@@ -39,4 +41,4 @@ def add_column_to_csv(logger, fname, col_name, pos=-1):
 # logger = Logger()
 # add_column_to_csv(logger, 'C:/Users/wils_ymarom/Documents/Data test/risk_scores.csv', 'TeamName_last', 7)
 # #add_column_to_csv(logger, 'C:/Users/wils_ymarom/Documents/Data test/risk_scores_hist.csv', 'TeamName_last', 7)
-# print('done')
\ No newline at end of file
+# print('done')
\ No newline at end of file
@@ -0,0 +1,236 @@
+import argparse
+import contextlib
+import csv
+import io
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from libs.logger import Logger
+from libs.compare_datasets import KeyIndex, compare_columns, compare_content, store_results, test_joins, test_pkey
+
+# Benchmarks the stages of compare_datasets.run_comparison on synthetic old/new datasets.
+# Each stage is timed (best of --repeat runs) and then run once more under tracemalloc for its peak memory.
+# Results are appended to a csv history, and every stage is compared with the last run of the same case.
+#
+#   python benchmark_compare_datasets.py                      all cases
+#   python benchmark_compare_datasets.py --cases tall wide    some of them
+#   python benchmark_compare_datasets.py --scale 0.1          same cases with a tenth of the rows
+
+HISTORY_FILE = 'benchmark_history.csv'
+HISTORY_COLS = ['run_id', 'commit', 'case', 'n_rows', 'n_cols', 'mismatch_rate', 'stage', 'seconds', 'peak_mb']
+
+# Share of a slowdown (vs. the last run) that is reported as a regression
+REGRESSION_THRESHOLD = 0.2
+# Stages quicker than this are too noisy to compare
+MIN_SECONDS = 0.01
+
+# dtypes gives the share of the content columns of each type. The key column 'id' comes on top of n_cols.
+BENCHMARK_CASES = {
+    'small': {'n_rows': 10000, 'n_cols': 10, 'dtypes': {'float': 4, 'int': 2, 'string': 2, 'date': 2}, 'date_format': '%Y-%m-%d', 'mismatch_rate': 0.01},
+    'tall': {'n_rows': 1000000, 'n_cols': 10, 'dtypes': {'float': 4, 'int': 2, 'string': 2, 'date': 2}, 'date_format': '%Y-%m-%d', 'mismatch_rate': 0.01},
+    'wide': {'n_rows': 50000, 'n_cols': 200, 'dtypes': {'float': 5, 'int': 2, 'string': 2, 'date': 1}, 'date_format': '%Y-%m-%d', 'mismatch_rate': 0.01},
+    'dates_day_first': {'n_rows': 200000, 'n_cols': 10, 'dtypes': {'float': 2, 'date': 8}, 'date_format': '%d/%m/%Y', 'mismatch_rate': 0.01, 'day_first_in_dates': True},
+    'datetimes': {'n_rows': 200000, 'n_cols': 10, 'dtypes': {'float': 2, 'datetime': 8}, 'date_format': '%Y-%m-%d %H:%M:%S', 'mismatch_rate': 0.01},
+    'high_mismatch': {'n_rows': 200000, 'n_cols': 20, 'dtypes': {'float': 4, 'int': 2, 'string': 2, 'date': 2}, 'date_format': '%Y-%m-%d', 'mismatch_rate': 0.3},
+}
+
+def get_col_types(n_cols, dtypes):
+
+    # Spread n_cols over the types in proportion to their shares, in a fixed order
+    shares = np.array(list(dtypes.values()), dtype=float)
+    counts = np.floor(n_cols*shares/shares.sum()).astype(int)
+    counts[np.argmax(shares)] += n_cols - counts.sum()
+
+    return [col_type for col_type, n in zip(dtypes, counts) for _ in range(n)]
+
+def make_datasets(n_rows, n_cols, dtypes, date_format='%Y-%m-%d', mismatch_rate=0.01, seed=0):
+
+    # Returns old and new datasets with the same keys (new in a shuffled order) and roughly mismatch_rate
+    # of each column's values changed, plus the date and datetime fields
+    rng = np.random.default_rng(seed)
+    strings = np.array([f'value_{i}' for i in range(50)], dtype=object)
+    start = np.datetime64('2015-01-01T00:00:00')
+
+    old = {'id': np.arange(n_rows)}
+    new = {}
+    date_fields = []
+    datetime_fields = []
+
+    for i, col_type in enumerate(get_col_types(n_cols, dtypes)):
+        col = f'{col_type}_{i}'
+        changed = rng.random(n_rows)<mismatch_rate
+
+        if col_type=='float':
+            values = rng.normal(size=n_rows)*1000
+            old[col] = values
+            new[col] = np.where(changed, values + 1, values)
+        elif col_type=='int':
+            values = rng.integers(0, 1000, n_rows)
+            old[col] = values
+            new[col] = np.where(changed, values + 1, values)
+        elif col_type=='string':
+            values = rng.choice(strings, n_rows)
+            values[rng.random(n_rows)<0.05] = None
+            old[col] = values
+            new[col] = np.where(changed, 'changed', values)
+        else:
+            seconds = rng.integers(0, 10*365*86400, n_rows)
+            if col_type=='date':
+                seconds -= seconds % 86400
+                date_fields.append(col)
+            else:
+                datetime_fields.append(col)
+            values = pd.Series(start + seconds.astype('timedelta64[s]'))
+            old[col] = values.dt.strftime(date_format).to_numpy(dtype=object)
+            new[col] = np.where(changed, (values + pd.Timedelta(days=1)).dt.strftime(date_format).to_numpy(dtype=object), old[col])
+
+    old_df = pd.DataFrame(old)
+    new_df = pd.DataFrame({'id': old['id'], **new})
+    new_df = new_df.iloc[rng.permutation(n_rows)].reset_index(drop=True)
+
+    return old_df, new_df, date_fields, datetime_fields
+
+def make_logger(logs=[]):
+
+    # A fresh logger for every run, so its history (written out by store_results) doesn't grow between repeats
+    logger = Logger()
+    logger.logs.extend(logs)
+
+    return logger
+
+def run_stage(fn, repeat=3, logs=[]):
+
+    # Best time over repeat runs, then one traced run for the peak memory. Log messages are swallowed.
+    # fn is called with a new logger holding logs. Returns the result and the logger of the last run as well.
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            logger = make_logger(logs)
+            start = time.perf_counter()
+            result = fn(logger)
+            seconds.append(time.perf_counter() - start)
+
+        logger = make_logger(logs)
+        tracemalloc.start()
+        try:
+            fn(logger)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result, logger, min(seconds), peak/2**20
+
+def run_case(name, case, scale=1.0, repeat=3, seed=0):
+
+    n_rows = max(int(case['n_rows']*scale), 1)
+    old_df, new_df, date_fields, datetime_fields = make_datasets(n_rows, case['n_cols'], case['dtypes'], case['date_format'], case['mismatch_rate'], seed)
+    day_first_in_dates = case.get('day_first_in_dates', False)
+    num_tolerances = 0.0001
+    pkey = 'id'
+
+    # the stages of run_comparison, in order
+    stages = [
+        ('key_index', lambda logger: KeyIndex(old_df, new_df, pkey)),
+        ('test_pkey', lambda logger: test_pkey(logger, old_df, new_df, pkey, key_index)),
+        ('test_joins', lambda logger: test_joins(logger, old_df, new_df, pkey, key_index)),
+        ('compare_columns', lambda logger: compare_columns(logger, old_df, new_df)),
+        ('compare_content', lambda logger: compare_content(logger, old_df, new_df, pkey, date_fields, datetime_fields, day_first_in_dates, num_tolerances, key_index)),
+    ]
+
+    rows = []
+    key_index = None
+    # the log messages of one comparison, what store_results writes out
+    comparison_logs = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stages.append(('store_results', lambda logger: store_results(logger, os.path.join(tmp_dir, 'results.txt'))))
+
+        for stage, fn in stages:
+            if stage=='store_results':
+                result, logger, seconds, peak_mb = run_stage(fn, repeat, comparison_logs)
+            else:
+                result, logger, seconds, peak_mb = run_stage(fn, repeat)
+                comparison_logs.extend(logger.logs)
+            if stage=='key_index':
+                key_index = result
+            rows.append({'case': name, 'n_rows': n_rows, 'n_cols': case['n_cols'], 'mismatch_rate': case['mismatch_rate'],
+                         'stage': stage, 'seconds': round(seconds, 4), 'peak_mb': round(peak_mb, 1)})
+
+    return rows
+
+def get_commit():
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def read_history(fname):
+
+    if not os.path.exists(fname):
+        return pd.DataFrame(columns=HISTORY_COLS)
+
+    return pd.read_csv(fname)
+
+def append_history(fname, rows):
+
+    write_header = not os.path.exists(fname)
+    with open(fname, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=HISTORY_COLS)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+def report(logger, rows, history):
+
+    # Compare each stage with the last run of the same case and size
+    for row in rows:
+        prev = history[(history['case']==row['case']) & (history['n_rows']==row['n_rows']) & (history['stage']==row['stage'])]
+        msg = f'{row["case"]:<16} {row["stage"]:<16} {row["seconds"]:>9.4f}s {row["peak_mb"]:>9.1f}MB'
+
+        if len(prev)==0:
+            logger.debug(msg)
+            continue
+
+        prev = prev.iloc[-1]
+        msg += f'  (last run {prev["seconds"]:.4f}s {prev["peak_mb"]:.1f}MB)'
+        slower = row['seconds']>MIN_SECONDS and row['seconds']>prev['seconds']*(1 + REGRESSION_THRESHOLD)
+        if slower or row['peak_mb']>prev['peak_mb']*(1 + REGRESSION_THRESHOLD):
+            logger.warning(msg)
+        else:
+            logger.debug(msg)
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the stages of compare_datasets on synthetic data')
+    parser.add_argument('--cases', nargs='+', default=list(BENCHMARK_CASES), choices=list(BENCHMARK_CASES))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the number of rows of every case')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history', default=HISTORY_FILE, help='csv file the results are appended to')
+    args = parser.parse_args()
+
+    logger = Logger()
+    logger.debug('Starting compare_datasets benchmark', True)
+
+    history = read_history(args.history)
+    run_id = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    commit = get_commit()
+
+    for name in args.cases:
+        logger.debug(f'Running case {name}', True)
+        rows = run_case(name, BENCHMARK_CASES[name], args.scale, args.repeat, args.seed)
+        report(logger, rows, history)
+        append_history(args.history, [{'run_id': run_id, 'commit': commit, **row} for row in rows])
+
+    logger.debug(f'Results appended to {args.history}')
+    logger.debug('Completed benchmark', True)
+
+if __name__=='__main__':
+    main()
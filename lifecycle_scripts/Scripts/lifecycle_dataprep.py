@@ -1,108 +1,169 @@
+import argparse
 import pandas as pd
 import numpy as np
 import datetime
 import json
+import os
 
-from libs.logger import Logger
+from libs.logger import Logger, traced
 from libs.connectors import DataConnector
+from libs.classifier import RuleClassifier
+from libs.state_store import StateStore
 
-use_local_data = True
-exclude_travel = False
+DEFAULT_MILESTONE_WEEKS = [2,4,6,8,12,16,20]
 
-def get_weekly_estimates(logger, cost, claims, exclude_travel):
+def get_weekly_estimates(logger, cost, claims, exclude_types=[]):
 
     logger.debug('Getting weekly estimates', True)
 
-    max_weeks = 20
+    activities, claim_dates = get_activity_weeks(logger, cost, claims)
+
+    return get_weekly_grid(logger, activities, claim_dates, exclude_types)
 
-    exclude_types = ['Travel', 'Reporting']
+@traced
+def get_activity_weeks(logger, cost, claims):
 
-    # exclude travel activities if required
-    if exclude_travel:
-        logger.debug('Removing travel activities')
-        cost = cost[~cost['type'].isin(exclude_types)]
+    # The week (from the claim's referral) of every activity of a known claim, the part of the weekly estimates
+    # shared by all the variants. Returns the activities and the claims' dates.
+    logger.debug('Getting the weeks of the activities')
 
-    # Prepare claim dates
-    claims_df = claims[['ClaimNo', 'first_referral', 'DateClosedLast']]
-    claims_df['first_referral'] = pd.to_datetime(claims_df['first_referral'])
-    claims_df['date_closed'] = pd.to_datetime(claims_df['DateClosedLast'])
+    # Prepare claim dates (one row per claim)
+    claims_df = claims[['ClaimNo', 'first_referral', 'DateClosedLast']].drop_duplicates('ClaimNo')
+    first_referral = pd.to_datetime(claims_df['first_referral']).to_numpy()
+    date_closed = pd.to_datetime(claims_df['DateClosedLast']).fillna(pd.Timestamp(datetime.date.today())).to_numpy()
 
-    # Work out day differences from date of referral
+    # Work out day differences from date of referral, for the activities of known claims
     activity_df = cost[cost['BillDate'].notnull()]
-    activity_df = activity_df.merge(claims_df[['ClaimNo', 'first_referral']], on='ClaimNo')
-    activity_df['activity_date'] = pd.to_datetime(activity_df['BillDate'].str[:10])
-    activity_df['diff_days'] = (activity_df['activity_date'] - activity_df['first_referral']).dt.days
-    activity_df = activity_df[activity_df['diff_days']>=0]
-
-    # Get weekly diffs and aggregate
-    activity_df['diff_weeks'] = (np.floor(activity_df['diff_days']/7)+1).astype('int')
-    agg = {
-        'Id': 'count',
-        'CostsTotalExTax':'sum',
-        'Duration':'sum'
+    claim_pos = pd.Index(claims_df['ClaimNo']).get_indexer(activity_df['ClaimNo'])
+    activity_date = pd.to_datetime(activity_df['BillDate'].str[:10]).to_numpy()
+    diff_days = pd.Series(activity_date - first_referral[claim_pos]).dt.days.to_numpy()
+    keep = (claim_pos>=0) & (diff_days>=0)
+
+    # Get weekly diffs
+    activities = pd.DataFrame({
+        'claim_pos': claim_pos[keep],
+        'diff_weeks': (np.floor(diff_days[keep]/7)+1).astype('int'),
+        'n_activities': activity_df['Id'].notna().to_numpy()[keep],
+        'total_cost': activity_df['CostsTotalExTax'].fillna(0).to_numpy(dtype=float)[keep],
+        'total_duration': activity_df['Duration'].fillna(0).to_numpy(dtype=float)[keep],
+        'type': activity_df['type'].to_numpy()[keep],
+    })
+    claim_dates = {'ClaimNo': claims_df['ClaimNo'].to_numpy(), 'first_referral': first_referral, 'date_closed': date_closed}
+
+    return activities, claim_dates
+
+@traced
+def get_weekly_grid(logger, activities, claim_dates, exclude_types=[]):
+
+    # The weekly estimates of one variant from get_activity_weeks, leaving out the activities of exclude_types
+    logger.debug('Building the weekly grid', True)
+
+    max_weeks = 20
+
+    # exclude activity types (e.g. travel) if required
+    if len(exclude_types)>0:
+        logger.debug(f'Removing {", ".join(exclude_types)} activities')
+        activities = activities[~activities['type'].isin(exclude_types)]
+
+    first_referral = claim_dates['first_referral']
+    date_closed = claim_dates['date_closed']
+    claim_pos = activities['claim_pos'].to_numpy()
+    diff_weeks = activities['diff_weeks'].to_numpy()
+    n_activities = activities['n_activities'].to_numpy()
+    total_cost = activities['total_cost'].to_numpy()
+    total_duration = activities['total_duration'].to_numpy()
+    type_codes, types = pd.factorize(activities['type'].to_numpy(), sort=True)
+
+    # The weekly grid: for every claim with activities (in order of first activity), weeks 1 to the week it closed
+    # (at most max_weeks-1). Claim c's weeks take rows offsets[c] to offsets[c] + n_weeks[c] - 1.
+    claim_codes, grid_claims = pd.factorize(claim_pos)
+    claim_days = pd.Series(date_closed[grid_claims] - first_referral[grid_claims]).dt.days.to_numpy()
+    week_num_max = (np.floor(claim_days/7)+1).astype('int')
+    n_weeks = np.clip(week_num_max, 0, max_weeks - 1)
+    offsets = np.cumsum(n_weeks) - n_weeks
+    n_rows = int(n_weeks.sum())
+
+    grid_claim = np.repeat(np.arange(len(grid_claims)), n_weeks)
+    week_num = np.arange(n_rows) - offsets[grid_claim] + 1
+
+    # Scatter the activities into the grid by row number, dropping the weeks outside it
+    in_grid = diff_weeks<=n_weeks[claim_codes]
+    rows = offsets[claim_codes[in_grid]] + diff_weeks[in_grid] - 1
+    weekly = {
+        'n_activities': np.bincount(rows, n_activities[in_grid], minlength=n_rows),
+        'total_cost': np.bincount(rows, total_cost[in_grid], minlength=n_rows),
+        'total_duration': np.bincount(rows, total_duration[in_grid], minlength=n_rows),
     }
-    weekly_df = activity_df.groupby(['ClaimNo', 'diff_weeks'], as_index=False).agg(agg)
-    weekly_df.rename(columns={'Id': 'n_activities', 'CostsTotalExTax':'total_cost', 'Duration':'total_duration'}, inplace=True)
-
-    # Create a separate aggregation by cost type
-    weekly_df_by_type = activity_df.groupby(['ClaimNo', 'diff_weeks', 'type'], as_index=False).agg(agg)
-    weekly_df_by_type.rename(columns={'Id': 'n_activities', 'CostsTotalExTax':'total_cost', 'Duration':'total_duration'}, inplace=True)
-    weekly_df_by_type_pivot = pd.pivot(weekly_df_by_type, index=['ClaimNo', 'diff_weeks'], values=['n_activities', 'total_cost', 'total_duration'], columns=['type'])
-    weekly_df_by_type_pivot.fillna(0, inplace=True)    
-    weekly_df_by_type_pivot.columns = [':'.join(col) for col in weekly_df_by_type_pivot.columns]
-    weekly_df_by_type_pivot.reset_index(inplace=True)
-
-    # Create a DF will all possible week numbers and claim numbers
-    week_nos = pd.DataFrame(pd.Series(range(1, max_weeks)), columns=['week_num'])
-    claim_nos = pd.DataFrame(activity_df['ClaimNo'].unique(), columns=['ClaimNo'])
-    week_nos['join_col']=1
-    claim_nos['join_col']=1
-    claim_week_nos = claim_nos.merge(week_nos).drop(columns=['join_col'])
-
-    # remove weeks that are beyond the claim closed date
-    claims_df['date_closed'] = pd.to_datetime(claims_df['date_closed'].fillna(datetime.date.today()))
-    claims_df['diff_days'] = (claims_df['date_closed'] - claims_df['first_referral']).dt.days
-    claims_df['week_num_max'] = (np.floor(claims_df['diff_days']/7)+1).astype('int')
-    claim_week_nos = claim_week_nos.merge(claims_df[['ClaimNo', 'week_num_max']])    
-    claim_week_nos = claim_week_nos[claim_week_nos['week_num'] <= claim_week_nos['week_num_max']]
-
-    # left-join the actual data zero-ing the nulls
-    weekly_df_all = claim_week_nos.merge(weekly_df, how='left', left_on=['ClaimNo', 'week_num'], right_on=['ClaimNo', 'diff_weeks'])
-    weekly_df_all = weekly_df_all.merge(weekly_df_by_type_pivot, how='left', left_on=['ClaimNo', 'week_num'], right_on=['ClaimNo', 'diff_weeks'])
-    weekly_df_all.fillna(0.0, inplace=True)
-    
+    has_activity = np.bincount(rows, minlength=n_rows)>0
+
+    # and the same by cost type, into a (row, type) grid
+    typed = in_grid & (type_codes>=0)
+    typed_rows = (offsets[claim_codes[typed]] + diff_weeks[typed] - 1)*len(types) + type_codes[typed]
+    has_typed_activity = np.bincount(typed_rows//max(len(types), 1), minlength=n_rows)>0
+
+    weekly_df_all = pd.DataFrame({
+        'ClaimNo': claim_dates['ClaimNo'][grid_claims][grid_claim],
+        'week_num': week_num,
+        'week_num_max': week_num_max[grid_claim],
+        # the week of the activities, 0 for weeks without any (as left by the joins this replaced)
+        'diff_weeks_x': np.where(has_activity, week_num, 0).astype(float),
+        **weekly,
+        'diff_weeks_y': np.where(has_typed_activity, week_num, 0).astype(float),
+    })
+
+    by_type = {}
+    for col, values in [('n_activities', n_activities), ('total_cost', total_cost), ('total_duration', total_duration)]:
+        sums = np.bincount(typed_rows, values[typed], minlength=n_rows*len(types)).reshape(n_rows, len(types))
+        for i, cost_type in enumerate(types):
+            by_type[f'{col}:{cost_type}'] = sums[:, i]
+    weekly_df_all = pd.concat([weekly_df_all, pd.DataFrame(by_type)], axis=1)
+
     return weekly_df_all
 
-def generate_milestones(logger, cost_weekly):
+@traced
+def generate_milestones(logger, cost_weekly, milestone_wks=DEFAULT_MILESTONE_WEEKS, active_mins=10):
 
     logger.debug('Generating milestones', True)
 
-    milestone_wks = [2,4,6,8,12,16,20]
-    active_mins = 10 # threshold for determinning that a week has been active (from analysis)
-    cost_weekly['active'] = cost_weekly['total_duration'] >= active_mins
-
-    milestone_dfs = []
+    # milestone_wks: weeks the totals are taken at, from the claim's first week
+    # active_mins: threshold for determinning that a week has been active (from analysis)
+    value_cols = [col for col in cost_weekly.columns if 'n_activities' in col or 'total_cost' in col or 'total_duration' in col]
+
+    # Rows sorted by claim and week, with each claim's running totals of every column (and of active weeks),
+    # so a claim's total up to a week is the running total on its last row up to that week.
+    claim_codes, claim_nos = pd.factorize(cost_weekly['ClaimNo'], sort=True)
+    week_num = cost_weekly['week_num'].to_numpy()
+    order = np.lexsort((week_num, claim_codes))
+    claim_codes = claim_codes[order]
+    week_num = week_num[order]
+
+    values = cost_weekly[value_cols].to_numpy(dtype=float)[order]
+    active = (cost_weekly['total_duration'].to_numpy()[order]>=active_mins).astype(float)
+    cum = pd.DataFrame(np.column_stack([values, active])).groupby(claim_codes).cumsum().to_numpy()
+
+    # each claim's first row, and the end of its weeks up to each milestone (found on claim*n_keys + week)
+    claim_ids = np.arange(len(claim_nos))
+    starts = np.searchsorted(claim_codes, claim_ids, side='left')
+    week_num_max = cost_weekly['week_num_max'].to_numpy()[order][starts]
+    n_keys = max(int(week_num.max()) if len(week_num)>0 else 0, max(milestone_wks)) + 1
+    keys = claim_codes.astype(np.int64)*n_keys + week_num
+
+    milestone_cols = {}
+    included = np.zeros(len(claim_nos), dtype=bool)
     for milestone in milestone_wks:
-        cost_weekly_subset = cost_weekly[(cost_weekly['week_num']<=milestone) & (cost_weekly['week_num_max']>=milestone)]
-        milestone_df = cost_weekly_subset.groupby('ClaimNo', as_index=False).sum()
-        milestone_df[f'activity_score{active_mins}'] = milestone_df['active']/milestone        
-
-        cols_to_keep = []
-        cols_to_keep_rename = []
-        for col in list(milestone_df.columns):
-            if 'n_activities' in col or 'total_cost' in col or 'total_duration' in col or 'activity_score' in col:
-                cols_to_keep.append(col)
-                cols_to_keep_rename.append(f'{col}_wk{milestone}')
-        
-        milestone_df.index = milestone_df['ClaimNo']
-        milestone_df = milestone_df[cols_to_keep]
-        milestone_df.columns = cols_to_keep_rename
-        milestone_dfs.append(milestone_df)
-
-    milestones_all = pd.concat(milestone_dfs, axis=1)
-    milestones_all['ClaimNo'] = milestones_all.index
-    milestones_all.reset_index(drop=True, inplace=True)
-    milestones_all.fillna(-1, inplace=True) # This signifies that the milestone is beyond when the case was closed
+        ends = np.searchsorted(keys, claim_ids.astype(np.int64)*n_keys + milestone, side='right')
+        totals = np.where((ends>starts)[:, None], cum[np.maximum(ends - 1, 0)], 0.0)
+        # -1 signifies that the milestone is beyond when the case was closed
+        reached = (week_num_max>=milestone) & (ends>starts)
+        included |= reached
+
+        for i, col in enumerate(value_cols):
+            milestone_cols[f'{col}_wk{milestone}'] = np.where(reached, totals[:, i], -1.0)
+        milestone_cols[f'activity_score{active_mins}_wk{milestone}'] = np.where(reached, totals[:, -1]/milestone, -1.0)
+
+    # claims that didn't reach any milestone are left out
+    milestones_all = pd.DataFrame(milestone_cols)[included].reset_index(drop=True)
+    milestones_all['ClaimNo'] = claim_nos[included]
 
     return milestones_all
 
@@ -130,49 +191,21 @@ def extract_cost_type(desc):
 
     return 'Other'
 
-def categorise_activities(logger, cost):
+@traced
+def categorise_activities(logger, cost, activity_rules, cache_path=None):
 
     logger.debug('Categorising activities', True)
 
     # the coding and classifications here are based on analysis conduced in May 2024.
-
-    # categorise from activity name first
-    cost['activity_lower'] = cost['ActivityName'].str.lower()
-    cost['activity_lower'].fillna('unknown', inplace=True)
-    cost['activity_grp'] = 'Other'
-    cost.loc[cost['activity_lower'].str.contains('training'), 'activity_grp'] = 'Coaching'
-    cost.loc[cost['activity_lower'].str.contains('coaching'), 'activity_grp'] = 'Coaching'
-    cost.loc[cost['activity_lower'].str.contains('conference'), 'activity_grp'] = 'Case Conference'
-    cost.loc[cost['activity_lower'].str.contains('liais'), 'activity_grp'] = 'Contact'
-    cost.loc[cost['activity_lower'].str.contains('phone'), 'activity_grp'] = 'Contact'
-    cost.loc[cost['activity_lower'].str.contains('email'), 'activity_grp'] = 'Contact'
-    cost.loc[cost['activity_lower'].str.contains('communic'), 'activity_grp'] = 'Contact'
-    cost.loc[cost['activity_lower'].str.contains('assessment'), 'activity_grp'] = 'Assessment'
-    cost.loc[cost['activity_lower'].str.contains('report'), 'activity_grp'] = 'Report'
-    cost.loc[cost['activity_lower'].str.contains('review'), 'activity_grp'] = 'Review'
-    cost.loc[cost['activity_lower'].str.contains('travel'), 'activity_grp'] = 'Travel'
-    
-    # now categorise from template name
-    cost['template_lower'] = cost['TemplateName'].str.lower()
-    cost['template_lower'].fillna('unknown', inplace=True)
-    cost['template_grp'] = 'Other'
-    cost.loc[cost['template_lower'].str.contains('assessment'), 'template_grp'] = 'Assessment'
-    cost.loc[cost['template_lower'].str.contains('training'), 'template_grp'] = 'Coaching'
-    cost.loc[cost['template_lower'].str.contains('coaching'), 'template_grp'] = 'Coaching'
-    cost.loc[cost['template_lower'].str.contains('conference'), 'template_grp'] = 'Case Conference'
-    cost.loc[cost['template_lower'].str.contains('report'), 'template_grp'] = 'Report'
-    cost.loc[cost['template_lower'].str.contains('review'), 'template_grp'] = 'Review'
-    cost.loc[cost['template_lower'].str.contains('travel'), 'template_grp'] = 'Travel'
-    cost.loc[cost['template_lower'].str.contains('contact'), 'template_grp'] = 'Contact'
-    
-    # and now combine them into a single classification
-    cost['type'] = cost['activity_grp']
-    cost.loc[(cost['template_grp']=='Report') & (cost['activity_grp']=='Other'), 'type'] = 'Report'
-    cost.loc[cost['template_grp'].isin(['Coaching', 'Case Conference', 'Travel', 'Review', 'Assessment']), 'type'] = cost['template_grp']
-    cost.loc[cost['activity_grp']=='Travel', 'type'] = 'Travel'    
+    # The keyword rules are activity_rules in config.json: a group from the activity name, a group from the
+    # template name, and rules combining them into a single classification.
+    # With cache_path only names not seen in earlier runs (with the same rules) are classified.
+    classifier = RuleClassifier(activity_rules, cache_path)
+    cost['activity_grp'], cost['template_grp'], cost['type'] = classifier.classify(cost['ActivityName'], cost['TemplateName'])
 
     return cost
 
+@traced
 def get_claim_totals(logger, claims_cost):
 
     logger.debug('Removing claims that have fixed-fee costs')
@@ -194,56 +227,234 @@ def get_claim_totals(logger, claims_cost):
     
     return all_costs
 
-def data_prep():
+def get_claim_state(claims):
+
+    # What a claim's outputs depend on besides its activities. week_num_max (as in get_weekly_estimates)
+    # moves on every week while a claim is open.
+    claim_state = claims[['ClaimNo', 'first_referral', 'DateClosedLast']].drop_duplicates('ClaimNo').reset_index(drop=True)
+    claim_state['first_referral'] = pd.to_datetime(claim_state['first_referral'])
+    claim_state['DateClosedLast'] = pd.to_datetime(claim_state['DateClosedLast'])
+    date_closed = claim_state['DateClosedLast'].fillna(pd.Timestamp(datetime.date.today()))
+    claim_state['week_num_max'] = np.floor((date_closed - claim_state['first_referral']).dt.days/7)+1
+
+    return claim_state
+
+def get_changed_claims(logger, state, claim_state, claims_cost):
+
+    # Claims billed on or after the day of the latest BillDate of the last run, new and removed claims, and claims
+    # whose referral, close date or current week changed. Activities can arrive after a run with the same BillDate
+    # as the last one it saw, so that whole day is looked at again (its claims just get recomputed once more).
+    prev_state = state.load('claims')
+    watermark = state.get('bill_date_watermark')
+
+    if watermark is not None:
+        watermark = pd.Timestamp(watermark).normalize()
+        billed = claims_cost.loc[pd.to_datetime(claims_cost['BillDate'])>=watermark, 'ClaimNo']
+    else:
+        billed = claims_cost['ClaimNo']
+    changed = set(billed.dropna())
+
+    merged = claim_state.merge(prev_state, on='ClaimNo', how='outer', suffixes=('', '_prev'), indicator=True)
+    moved = pd.Series(False, index=merged.index)
+    for col in ['first_referral', 'DateClosedLast', 'week_num_max']:
+        moved |= ~((merged[col]==merged[f'{col}_prev']) | (merged[col].isna() & merged[f'{col}_prev'].isna()))
+    changed |= set(merged.loc[(merged['_merge']=='left_only') | ((merged['_merge']=='both') & moved), 'ClaimNo'])
+    removed = set(merged.loc[merged['_merge']=='right_only', 'ClaimNo'])
+
+    logger.debug(f'{len(billed)} activities billed since {watermark}, {len(changed)} claims to update and {len(removed)} removed')
+
+    return changed, removed
+
+def merge_claims(old_df, new_df, drop_claims, sort_cols):
+
+    # old_df without the claims in drop_claims, plus new_df
+    if old_df is not None:
+        new_df = new_df.astype({'ClaimNo': old_df['ClaimNo'].dtype})
+        new_df = pd.concat([old_df[~old_df['ClaimNo'].isin(drop_claims)], new_df], ignore_index=True)
+
+    return new_df.sort_values(sort_cols, kind='stable').reset_index(drop=True)
+
+def get_variants(config):
+
+    # The outputs to produce in one run, from variants in the config, e.g.
+    #   "variants": [{"suffix": "", "exclude_types": []}, {"suffix": "_ex_travel", "exclude_types": ["Travel", "Reporting"]}]
+    # suffix: added to the cost_weekly and milestones file names, exclude_types: activity types left out of them.
+    # milestone_weeks and active_mins default to the ones at the top of the config.
+    variants = config.get('variants', [{'suffix': '', 'exclude_types': []}])
+
+    return [{
+        'suffix': variant.get('suffix', ''),
+        'exclude_types': list(variant.get('exclude_types', [])),
+        'milestone_weeks': list(variant.get('milestone_weeks', config.get('milestone_weeks', DEFAULT_MILESTONE_WEEKS))),
+        'active_mins': variant.get('active_mins', config.get('active_mins', 10)),
+    } for variant in variants]
+
+def get_claim_types(activities, claim_dates, exclude_types=[]):
+
+    # The cost types of each claim's activities (as from get_activity_weeks), which decide the weekly columns
+    activities = activities[~activities['type'].isin(exclude_types)]
+    claim_types = pd.DataFrame({'ClaimNo': claim_dates['ClaimNo'][activities['claim_pos'].to_numpy()], 'type': activities['type'].to_numpy()})
+
+    return claim_types.dropna().drop_duplicates().reset_index(drop=True)
+
+def get_outputs(logger, claims, claims_cost, variants, previous=None, drop_claims=set()):
+
+    # claim_cost_totals, and cost_weekly and milestones for every variant. The activity weeks are worked out once
+    # and only the weekly grid and the milestones are done per variant.
+    # previous: state of the last run (incremental mode, tables None when rebuilding) whose claims in drop_claims are
+    # being recomputed. The cost types of every claim are kept in it as well, so the weekly columns can be lined up
+    # with what a full run would give.
+    # Returns the outputs by name, None if there are cost types the previous outputs don't have columns for.
+    outputs = {'claim_cost_totals': get_claim_totals(logger, claims_cost)}
+    activities, claim_dates = get_activity_weeks(logger, claims_cost, claims)
+
+    for variant in variants:
+        weekly_name, milestones_name = f"cost_weekly{variant['suffix']}", f"milestones{variant['suffix']}"
+        cost_weekly = get_weekly_grid(logger, activities, claim_dates, variant['exclude_types'])
+
+        if previous is not None:
+            types_name = f"claim_types{variant['suffix']}"
+            claim_types = get_claim_types(activities, claim_dates, variant['exclude_types'])
+            outputs[types_name] = merge_claims(previous[types_name], claim_types, drop_claims, ['ClaimNo', 'type'])
+
+        if previous is not None and previous[weekly_name] is not None:
+            # a new cost type adds columns for every claim, one no claim has any more is dropped
+            columns = list(previous[weekly_name].columns)
+            old_types = {col.split(':', 1)[1] for col in columns if ':' in col}
+            types = set(outputs[types_name]['type'])
+            if not types<=old_types:
+                logger.debug(f'New cost types found for {weekly_name}')
+                return None
+            if len(old_types - types)>0:
+                logger.debug(f'Cost types no longer found for {weekly_name}: {", ".join(sorted(old_types - types))}')
+            columns = [col for col in columns if ':' not in col or col.split(':', 1)[1] in types]
+            cost_weekly = cost_weekly.reindex(columns=columns, fill_value=0.0)
+
+        outputs[weekly_name] = cost_weekly
+        outputs[milestones_name] = generate_milestones(logger, cost_weekly, variant['milestone_weeks'], variant['active_mins'])
+
+    return outputs
+
+@traced
+def update_outputs(logger, state, claims, claims_cost, variants, full_rebuild=False):
+
+    # Incremental mode: the outputs of the last run are kept in state (a StateStore) and only the claims that may
+    # have changed since are recomputed and merged in. Activities edited or removed without a later BillDate
+    # aren't picked up, so a full rebuild (also done whenever the settings change) recomputes every claim.
+    # Outputs are sorted by ClaimNo (and week_num), so a full rebuild and an incremental run can be compared.
+    # Returns the outputs by file name.
+    settings = {'variants': variants}
+    claim_state = get_claim_state(claims)
+    names = ['claim_cost_totals'] + [f"{name}{variant['suffix']}" for variant in variants for name in ['cost_weekly', 'milestones']]
+    state_names = names + [f"claim_types{variant['suffix']}" for variant in variants]
+
+    if full_rebuild or state.get('settings')!=settings or any(not os.path.exists(state.get_table_path(name)) for name in state_names + ['claims']):
+        logger.debug('Rebuilding the outputs for all claims', True)
+        changed, removed = set(claim_state['ClaimNo']) | set(claims_cost['ClaimNo'].dropna()), set()
+        previous = {name: None for name in state_names}
+    else:
+        logger.debug('Updating the outputs of changed claims', True)
+        changed, removed = get_changed_claims(logger, state, claim_state, claims_cost)
+        previous = {name: state.load(name) for name in state_names}
+
+    drop_claims = changed | removed
+    outputs = get_outputs(logger, claims[claims['ClaimNo'].isin(changed)], claims_cost[claims_cost['ClaimNo'].isin(changed)], variants,
+                          previous, drop_claims)
+    if outputs is None:
+        return update_outputs(logger, state, claims, claims_cost, variants, True)
+
+    for name in names:
+        # the previous rows without the columns of cost types that are gone
+        sort_cols = ['ClaimNo', 'week_num'] if name.startswith('cost_weekly') else ['ClaimNo']
+        old_df = previous[name][outputs[name].columns] if previous[name] is not None else None
+        outputs[name] = merge_claims(old_df, outputs[name], drop_claims, sort_cols)
+    # (the claim types are merged in get_outputs)
+    for name in state_names:
+        state.save(name, outputs[name])
+    state.save('claims', claim_state)
+    bill_dates = claims_cost['BillDate'].dropna()
+    state.set('bill_date_watermark', bill_dates.max() if len(bill_dates)>0 else state.get('bill_date_watermark'))
+    state.set('settings', settings)
+    state.save_values()
+
+    return {name: outputs[name] for name in names}
+
+def save_output(data_conn, df, fname, output_formats):
+
+    for fmt in output_formats:
+        data_conn.write_data(df, fname, fmt=fmt)
+
+def data_prep(config_path='config.json', full_rebuild=False, use_local_data=True):
 
     logger = Logger()
 
-    with open('config.json', 'rb') as f:
+    with open(config_path, 'rb') as f:
         config = json.load(f)
 
     data_dir_in = config['data_folder_in']    
     data_dir_out = config['data_folder_out']
     ref_data_dir = config['ref_data_folder']
+    # csv by default, add parquet or feather for outputs that are quicker to reload
+    output_formats = config.get('output_formats', ['csv'])
+    variants = get_variants(config)
 
     logger.debug('Starting lifecycle dataprep', True)
 
-    data_conn = DataConnector(logger, 'creds.json', data_dir_in, use_local_data, data_dir_out)    
-
-    claims = data_conn.read_data('claim_rollup', csv=True)
-    cost = data_conn.read_data('case_bill', csv=True)
-    claim_rollup_mapping = data_conn.read_data('claim_rollup_mapping', csv=True)
+    # optional cache_folder in the config keeps cleaned copies of the inputs between runs,
+    # schemas.json holds the dtypes of the input tables
+    data_conn = DataConnector(logger, 'creds.json', data_dir_in, use_local_data, data_dir_out, cache_dir=config.get('cache_folder'), schema_path='schemas.json')    
+
+    data = data_conn.read_many({
+        'claim_rollup': {'csv': True},
+        'case_bill': {'csv': True},
+        'claim_rollup_mapping': {'csv': True},
+        'CaseBillTemplate': {'csv': True},
+    })
+    claims = data['claim_rollup']
+    cost = data['case_bill']
+    claim_rollup_mapping = data['claim_rollup_mapping']
      
     # TODO: modify the ETL to include the template name in the case_bill extract, and the delete the below two lines
-    cost_templates = data_conn.read_data('CaseBillTemplate', csv=True)
+    cost_templates = data['CaseBillTemplate']
     #cost = cost[['Id']].merge(cost_templates[['Id', 'TemplateName', 'ActivityName', 'BillDate', 'CostsTotalExTax']], on='Id', how='left')
     cost_templates['CostsTotalExTax'] = cost_templates['SubTotal'].fillna(0)/100
     cost_templates['Duration'] = cost_templates['Minutes'].fillna(0)
     #cost_templates = cost_templates[cost_templates['BillType']<3]
     cost = cost_templates
 
-    cost = categorise_activities(logger, cost)
+    classes_cache = os.path.join(config['cache_folder'], 'activity_classes.json') if config.get('cache_folder') else None
+    cost = categorise_activities(logger, cost, config['activity_rules'], classes_cache)
     claims_cost = claim_rollup_mapping.merge(cost, how='left', on=['CaseServiceId'])
-    
-    claim_totals = get_claim_totals(logger, claims_cost)
-    claim_totals.to_csv(f'{data_dir_out}/claim_cost_totals.csv', index=False)
 
-    cost_weekly = get_weekly_estimates(logger, claims_cost, claims, exclude_travel)    
-    if exclude_travel:
-        cost_weekly.to_csv(f'{data_dir_out}/cost_weekly_ex_travel.csv', index=False)
+    # with a state_folder in the config only the claims that changed since the last run are recomputed
+    if config.get('state_folder'):
+        state = StateStore(config['state_folder'])
+        outputs = update_outputs(logger, state, claims, claims_cost, variants, full_rebuild)
     else:
-        cost_weekly.to_csv(f'{data_dir_out}/cost_weekly.csv', index=False)
+        outputs = get_outputs(logger, claims, claims_cost, variants)
 
-    milestones = generate_milestones(logger, cost_weekly)
-
-    if exclude_travel:
-        milestones.to_csv(f'{data_dir_out}/milestones_ex_travel.csv', index=False)
-    else:
-        milestones.to_csv(f'{data_dir_out}/milestones.csv', index=False)
+    for fname, df in outputs.items():
+        save_output(data_conn, df, fname, output_formats)
 
     data_conn.close_connections()
+
+    # time, memory and rows of each stage, the trace opens in chrome://tracing
+    logger.log_spans()
+    logger.write_trace(f'{data_dir_out}/dataprep_trace.json')
     
     logger.debug('Completed lifcycle dataprep', True)
 
-    
-data_prep()
-print('done')
+def main():
+
+    parser = argparse.ArgumentParser(description='Claim cost totals, weekly estimates and milestones for every variant in the config')
+    parser.add_argument('--config', default='config.json', help='path to the config (default config.json)')
+    parser.add_argument('--full-rebuild', action='store_true', help='recompute every claim when a state_folder is set')
+    parser.add_argument('--remote', action='store_true', help='read the inputs from the database rather than local files')
+    args = parser.parse_args()
+
+    data_prep(args.config, args.full_rebuild, not args.remote)
+    print('done')
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+
+import pandas as pd
+
+from Lib.aml_datalake_loader import DataLoader, LocalStorage
+
+# DataLoader against files in a local folder
+
+def write_source(root, fname, text):
+
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, fname), 'w') as f:
+        f.write(text)
+
+def test_datalake_csv_and_cache_hit(tmp_path):
+
+    src, out = str(tmp_path / 'src'), str(tmp_path / 'out')
+    write_source(src, 'claim_rollup.csv', 'C1,2024-01-01,1.5\nC2,2024-02-01,2.0\n')
+    loader = DataLoader(source='datalake', filename='claim_rollup.csv', output_dir=out, storage=LocalStorage(src))
+
+    df = loader.load_data(datalake_path=os.path.join(src, 'claim_rollup.csv'))
+    expected = pd.read_csv(os.path.join(src, 'claim_rollup.csv'), header=None)
+    pd.testing.assert_frame_equal(df, expected)
+
+    # the local CSV keeps the original name and is written as before: header row of column numbers
+    with open(os.path.join(out, 'claim_rollup.csv')) as f:
+        assert f.read()==expected.to_csv(index=False)
+    assert os.path.exists(os.path.join(out, 'claim_rollup.parquet'))
+
+    # read from the parquet copy the second time, with the same column labels
+    hit = loader.load_data(datalake_path=os.path.join(src, 'claim_rollup.csv'))
+    pd.testing.assert_frame_equal(hit, expected)
+
+def test_aml_asset_reloaded_when_changed(tmp_path):
+
+    src, out = str(tmp_path / 'src'), str(tmp_path / 'out')
+    write_source(src, 'case_bill.csv', 'ClaimNo,Cost\nC1,1.5\n')
+    loader = DataLoader(source='aml', filename='case_bill.csv', output_dir=out, storage=LocalStorage(src))
+
+    assert loader.load_data()['ClaimNo'].tolist()==['C1']
+    pd.testing.assert_frame_equal(loader.load_data(), pd.DataFrame({'ClaimNo': ['C1'], 'Cost': [1.5]}))
+
+    write_source(src, 'case_bill.csv', 'ClaimNo,Cost\nC1,1.5\nC2,2.5\n')
+    assert loader.load_data()['ClaimNo'].tolist()==['C1', 'C2']
+    assert pd.read_csv(os.path.join(out, 'case_bill.csv'))['ClaimNo'].tolist()==['C1', 'C2']
+
+def test_load_many_paths(tmp_path):
+
+    src, out = str(tmp_path / 'src'), str(tmp_path / 'out')
+    write_source(src, 'a.csv', 'x,y\n1,2\n')
+    write_source(src, 'b.csv', 'x,y\n3,4\n')
+    loader = DataLoader(source='aml', output_dir=out, storage=LocalStorage(src))
+
+    paths = loader.load_many(['a.csv', 'b.csv', 'missing.csv'], read=False)
+    assert paths['a.csv']==os.path.join(out, 'a.parquet')
+    assert pd.read_parquet(paths['b.csv'])['x'].tolist()==[3]
+    assert paths['missing.csv'] is None
+
+def test_save_parquet_leaves_frame_unchanged(tmp_path):
+
+    loader = DataLoader(output_dir=str(tmp_path), storage=LocalStorage(str(tmp_path)))
+    df = pd.DataFrame({0: [1, 'a', None], 1: [1.0, 2.0, 3.0]})
+    before = df.copy()
+
+    loader.save_parquet(df, str(tmp_path / 'out.parquet'))
+
+    pd.testing.assert_frame_equal(df, before)
+    saved = pd.read_parquet(str(tmp_path / 'out.parquet'))['0']
+    assert saved[:2].tolist()==['1', 'a'] and pd.isna(saved[2])
@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from Lib.classifier import RuleClassifier
+
+# RuleClassifier with the activity_rules layout of config.json
+
+RULES = {
+    'default': 'Other',
+    'activity': [['travel', 'Travel'], ['report', 'Report'], ['training', 'Coaching']],
+    'template': [['contact', 'Contact'], ['assessment', 'Assessment']],
+    'type': [
+        {'activity': ['Travel'], 'use': 'activity'},
+        {'activity': ['Other'], 'template': ['Contact'], 'use': 'template'}
+    ]
+}
+
+ACTIVITIES = pd.Series(['Travel to site', 'Write REPORT', None, 'Phone call', 'Training day', 'Phone call'])
+TEMPLATES = pd.Series(['Contact note', None, 'Initial assessment', 'Client contact', 'Other', 'Misc'])
+
+def check_groups(activity_grp, template_grp, types):
+
+    assert activity_grp.tolist()==['Travel', 'Report', 'Other', 'Other', 'Coaching', 'Other']
+    assert template_grp.tolist()==['Contact', 'Other', 'Assessment', 'Contact', 'Other', 'Other']
+    assert types.tolist()==['Travel', 'Report', 'Other', 'Contact', 'Coaching', 'Other']
+
+def test_classify():
+
+    classifier = RuleClassifier(RULES)
+    check_groups(*classifier.classify(ACTIVITIES, TEMPLATES))
+
+    # categorical columns give the same groups
+    check_groups(*classifier.classify(ACTIVITIES.astype('category'), TEMPLATES.astype('category')))
+
+def test_cache_round_trip(tmp_path):
+
+    cache_path = str(tmp_path / 'cache' / 'classifier.json')
+    check_groups(*RuleClassifier(RULES, cache_path).classify(ACTIVITIES, TEMPLATES))
+
+    with open(cache_path) as f:
+        cache = json.load(f)
+    assert cache['activity']['Write REPORT']=='Report'
+    assert cache['template']['Initial assessment']=='Assessment'
+
+    # names are taken from the cache, so an edited entry shows through
+    cache['activity']['Phone call'] = 'Travel'
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f)
+    classifier = RuleClassifier(RULES, cache_path)
+    activity_grp, _, types = classifier.classify(ACTIVITIES, TEMPLATES)
+    assert activity_grp[3]=='Travel' and types[3]=='Travel'
+    assert not classifier.cache_changed
+
+def test_cache_reset_when_rules_change(tmp_path):
+
+    cache_path = str(tmp_path / 'classifier.json')
+    RuleClassifier(RULES, cache_path).classify(ACTIVITIES, TEMPLATES)
+
+    rules = {**RULES, 'activity': [['phone', 'Call']] + RULES['activity']}
+    activity_grp, _, _ = RuleClassifier(rules, cache_path).classify(ACTIVITIES, TEMPLATES)
+    assert activity_grp[3]=='Call'
+
+    with open(cache_path) as f:
+        assert json.load(f)['activity']['Phone call']=='Call'
+
+def test_new_names_added_to_cache(tmp_path):
+
+    cache_path = str(tmp_path / 'classifier.json')
+    classifier = RuleClassifier(RULES, cache_path)
+    classifier.classify(ACTIVITIES[:2], TEMPLATES[:2])
+    activity_grp, _, _ = RuleClassifier(RULES, cache_path).classify(ACTIVITIES, TEMPLATES)
+
+    assert np.array_equal(activity_grp, RuleClassifier(RULES).classify(ACTIVITIES, TEMPLATES)[0])
+    with open(cache_path) as f:
+        assert set(json.load(f)['activity'])=={'Travel to site', 'Write REPORT', 'Phone call', 'Training day'}
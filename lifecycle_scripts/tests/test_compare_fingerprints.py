@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from Lib.compare_datasets import run_comparison
+from Lib.compare_fingerprints import run_comparison_fingerprint
+from Lib.logger import Logger
+
+def count_mismatched_rows(combined_df):
+
+    return int((~combined_df['diff']).sum())
+
+def test_large_ints_are_not_matched_through_float():
+
+    # above 2**53 neighbouring ints are the same float, the fingerprints must still tell them apart
+    old_df = pd.DataFrame({'id': np.arange(6), 'bigi': np.full(6, 10**18, dtype='int64'), 'x': np.arange(6)*1.0})
+    new_df = old_df.copy()
+    new_df.loc[2, 'bigi'] = 10**18 + 1
+
+    serial = run_comparison(Logger(console=False), old_df.copy(), new_df.copy(), 'id', [], [], [])
+    fingerprint = run_comparison_fingerprint(Logger(console=False), old_df.copy(), new_df.copy(), 'id', [], [], [])
+
+    assert count_mismatched_rows(serial)==1
+    assert count_mismatched_rows(fingerprint)==count_mismatched_rows(serial)
+
+def test_int_tolerance_buckets():
+
+    # differences within a wider tolerance still match, as in the serial comparison
+    old_df = pd.DataFrame({'id': np.arange(4), 'n': np.array([10, 20, 30, 40], dtype='int64')})
+    new_df = old_df.copy()
+    new_df['n'] = np.array([11, 20, 35, 40], dtype='int64')
+
+    serial = run_comparison(Logger(console=False), old_df.copy(), new_df.copy(), 'id', [], [], [], num_tolerances=3)
+    fingerprint = run_comparison_fingerprint(Logger(console=False), old_df.copy(), new_df.copy(), 'id', [], [], [], num_tolerances=3)
+
+    assert count_mismatched_rows(serial)==1
+    assert count_mismatched_rows(fingerprint)==count_mismatched_rows(serial)
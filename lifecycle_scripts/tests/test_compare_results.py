@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from Lib.compare_datasets import run_comparison
+from Lib.logger import Logger
+
+def test_parquet_store_with_all_null_values(tmp_path):
+
+    # column a is all NaN in the old data, so its pieces have no old values at all, while b and s mismatch
+    # in other partitions. Every piece has to be written with the same schema for the store to read back.
+    n = 200
+    old_df = pd.DataFrame({'id': np.arange(n), 'a': np.nan, 'b': np.arange(n)*1.0, 's': 'x'})
+    new_df = old_df.copy()
+    new_df['a'] = 1.0
+    new_df.loc[n-1, 'b'] = 5.0
+    new_df.loc[3, 's'] = None
+
+    store_path = str(tmp_path / 'mismatches.parquet')
+    result = run_comparison(Logger(console=False), old_df, new_df, 'id', [], [], [], workers=2, mismatch_store=store_path)
+
+    mismatches = result.mismatches()
+    assert len(mismatches)==n + 2
+    assert mismatches.loc[mismatches['column_name']=='a', 'old_value'].isna().all()
+    assert result.mismatches('s')['new_value'].isna().all()
+    assert result.columns.set_index('column')['mismatches'].to_dict()=={'a': n, 'b': 1, 's': 1}
+    assert result.columns.set_index('column')['max_abs_diff']['b']==194.0
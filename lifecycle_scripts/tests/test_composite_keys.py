@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+from Lib.compare_datasets import run_comparison
+from Lib.compare_streaming import run_comparison_streaming
+from Lib.logger import Logger
+
+def make_data(n):
+
+    old_df = pd.DataFrame({'a': np.arange(n) % 3, 'b': np.arange(n), 'x': np.arange(n)*1.0})
+    new_df = old_df.copy()
+    if n>0:
+        new_df.loc[0, 'x'] = 100.0
+
+    return old_df, new_df
+
+def test_composite_key_empty_frames():
+
+    old_df, new_df = make_data(0)
+    combined_df = run_comparison(Logger(console=False), old_df, new_df, ['a', 'b'], [], [], [])
+
+    assert len(combined_df)==0
+
+def test_composite_key_with_workers():
+
+    # with 2 rows over the partitions, some partitions are empty
+    old_df, new_df = make_data(2)
+    combined_df = run_comparison(Logger(console=False), old_df, new_df, ['a', 'b'], [], [], [], workers=2)
+
+    assert len(combined_df)==2
+    assert int((~combined_df['diff']).sum())==1
+
+def test_composite_key_streaming():
+
+    old_df, new_df = make_data(2)
+    result = run_comparison_streaming(Logger(console=False), old_df, new_df, ['a', 'b'], [], [], [], n_partitions=8)
+
+    assert result['compared']==2
+    assert result['match_rates']['x']==0.5
+
+def test_composite_key_matches_serial():
+
+    old_df, new_df = make_data(500)
+    serial = run_comparison(Logger(console=False), old_df.copy(), new_df.copy(), ['a', 'b'], [], [], [])
+    parallel = run_comparison(Logger(console=False), old_df.copy(), new_df.copy(), ['a', 'b'], [], [], [], workers=3)
+    streamed = run_comparison_streaming(Logger(console=False), old_df.copy(), new_df.copy(), ['a', 'b'], [], [], [], n_partitions=8, chunksize=100)
+
+    assert len(parallel)==len(serial)==streamed['compared']==500
+    assert int((~parallel['diff']).sum())==int((~serial['diff']).sum())==1
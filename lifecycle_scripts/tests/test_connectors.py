@@ -0,0 +1,137 @@
+import functools
+import json
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from Lib import connectors
+from Lib.connectors import DataConnector
+from Lib.logger import Logger
+from Lib.read_spec import ReadSpec
+
+# DataConnector against SQLite, through its connect argument
+
+@pytest.fixture
+def db_path(tmp_path):
+
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute('create table claims (ClaimNo text, BillType integer, Cost real)')
+    conn.executemany('insert into claims values (?, ?, ?)', [(f'C{i:02d}', i % 3, i*1.5) for i in range(10)])
+    conn.execute('create table totals (ClaimNo text, Total real)')
+    conn.commit()
+    conn.close()
+
+    return path
+
+def make_connector(db_path, tmp_path, connect=None):
+
+    connect = connect or functools.partial(sqlite3.connect, db_path, check_same_thread=False)
+    return DataConnector(Logger(console=False), None, str(tmp_path), False, str(tmp_path), connect=connect, sql_dialect='sqlite')
+
+def test_pool_per_connect_function(db_path, tmp_path):
+
+    other_path = str(tmp_path / 'other.db')
+    conn = sqlite3.connect(other_path)
+    conn.execute('create table claims (ClaimNo text, BillType integer, Cost real)')
+    conn.execute("insert into claims values ('X', 1, 1.0)")
+    conn.commit()
+    conn.close()
+
+    connect = functools.partial(sqlite3.connect, db_path, check_same_thread=False)
+    first = make_connector(db_path, tmp_path, connect)
+    second = make_connector(db_path, tmp_path, connect)
+    other = make_connector(other_path, tmp_path)
+
+    assert first.pool is second.pool
+    assert other.pool is not first.pool
+    assert len(first.read_data('claims'))==10
+    assert other.read_data('claims')['ClaimNo'].tolist()==['X']
+
+    first.close_connections(close_pool=True)
+    other.close_connections(close_pool=True)
+
+def test_odbc_pool_shared_by_connection_string(tmp_path, monkeypatch):
+
+    # the default pool is made from the connection string, not from the first connector that asked for it
+    creds_path = str(tmp_path / 'creds.json')
+    with open(creds_path, 'w') as f:
+        json.dump({'server': 'srv', 'username_db': 'user', 'password_db': 'pwd', 'driver': 'drv'}, f)
+
+    opened = []
+    def connect_odbc(connection_string):
+        opened.append(connection_string)
+        return sqlite3.connect(':memory:', check_same_thread=False)
+    monkeypatch.setattr(connectors, 'connect_odbc', connect_odbc)
+
+    first = DataConnector(Logger(console=False), creds_path, str(tmp_path), False, str(tmp_path), database='db1')
+    second = DataConnector(Logger(console=False), creds_path, str(tmp_path), False, str(tmp_path), database='db1')
+    other = DataConnector(Logger(console=False), creds_path, str(tmp_path), False, str(tmp_path), database='db2')
+
+    assert first.pool is second.pool
+    assert other.pool is not first.pool
+    second.run_sql_query('select 1 as x')
+    assert opened==['DRIVER=drv;SERVER=srv;DATABASE=db1;UID=user;PWD=pwd']
+
+    connectors.close_pools()
+
+def test_pool_close_closes_released_connections(db_path, tmp_path):
+
+    data_conn = make_connector(db_path, tmp_path)
+    conn = data_conn.pool.acquire()
+    data_conn.pool.close()
+    data_conn.pool.release(conn)
+
+    assert data_conn.pool.n_open==0
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('select 1')
+
+def test_read_data_with_spec(db_path, tmp_path):
+
+    data_conn = make_connector(db_path, tmp_path)
+    spec = ReadSpec(columns=['ClaimNo', 'Cost'], filters=[('BillType', 'in', [1, 2])], limit=4)
+    df = data_conn.read_data('claims', spec=spec)
+
+    assert list(df.columns)==['ClaimNo', 'Cost']
+    assert df['ClaimNo'].tolist()==['C01', 'C02', 'C04', 'C05']
+
+    data_conn.close_connections(close_pool=True)
+
+def test_read_data_iter_chunks(db_path, tmp_path):
+
+    data_conn = make_connector(db_path, tmp_path)
+    chunks = list(data_conn.read_data_iter('claims', sql_filter='where BillType = ?', params=[0], chunksize=3))
+
+    assert [len(chunk) for chunk in chunks]==[3, 1]
+    assert pd.concat(chunks)['ClaimNo'].tolist()==['C00', 'C03', 'C06', 'C09']
+
+    data_conn.close_connections(close_pool=True)
+
+def test_read_many(db_path, tmp_path):
+
+    data_conn = make_connector(db_path, tmp_path)
+    data = data_conn.read_many({'claims': {}, 'hourly': {'table_name': 'claims', 'sql_filter': 'where BillType = 1'}, 'missing': {}})
+
+    assert len(data['claims'])==10
+    assert len(data['hourly'])==3
+    assert data['missing'] is None
+
+    data_conn.close_connections(close_pool=True)
+
+def test_write_data_sql(db_path, tmp_path):
+
+    data_conn = make_connector(db_path, tmp_path)
+    df = pd.DataFrame({'ClaimNo': ['C00', 'C01'], 'Total': [1.0, None]})
+
+    data_conn.write_data(df, 'totals', fmt='sql')
+    data_conn.write_data(df.iloc[:1], 'totals', insert=True, fmt='sql')
+    assert len(data_conn.read_data('totals'))==3
+
+    # without insert the table is replaced
+    data_conn.write_data(df, 'totals', fmt='sql')
+    totals = data_conn.read_data('totals')
+    assert totals['ClaimNo'].tolist()==['C00', 'C01']
+    assert totals['Total'].isna().tolist()==[False, True]
+
+    data_conn.close_connections(close_pool=True)
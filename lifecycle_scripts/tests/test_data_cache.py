@@ -0,0 +1,46 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from Lib.connectors import DataConnector
+from Lib.data_cache import DataCache
+from Lib.logger import Logger
+
+def test_put_get_and_evict(tmp_path):
+
+    cache = DataCache(str(tmp_path / 'cache'), max_mb=1)
+    df = pd.DataFrame({'a': np.random.default_rng(0).random(50000)})
+
+    first = cache.make_key('t', 1)
+    cache.put(first, df)
+    pd.testing.assert_frame_equal(cache.get(first), df)
+    assert cache.get(cache.make_key('t', 2)) is None
+
+    # each entry is ~400KB, the least recently used go once the cache is over 1MB
+    os.utime(os.path.join(cache.cache_dir, first + '.arrow'), (time.time() - 100,)*2)
+    for i in range(2, 5):
+        cache.put(cache.make_key('t', i), df)
+    assert cache.get(first) is None
+    assert cache.get(cache.make_key('t', 4)) is not None
+
+def test_read_data_hit_and_invalidation(tmp_path):
+
+    data_dir = str(tmp_path)
+    path = os.path.join(data_dir, 'claims.txt')
+    pd.DataFrame({'ClaimNo': [' C1 ', 'C2'], 'Cost': [1.0, 2.0]}).to_csv(path, sep='\t', index=False)
+
+    logger = Logger(console=False)
+    data_conn = DataConnector(logger, None, data_dir, True, data_dir, cache_dir=os.path.join(data_dir, 'cache'))
+
+    first = data_conn.read_data('claims')
+    second = data_conn.read_data('claims')
+    pd.testing.assert_frame_equal(first, second)
+    assert second['ClaimNo'].tolist()==['C1', 'C2']
+    assert any('from cache' in log['message'] for log in logger.logs)
+
+    # a changed source gets a new entry
+    pd.DataFrame({'ClaimNo': ['C3'], 'Cost': [3.0]}).to_csv(path, sep='\t', index=False)
+    os.utime(path, (time.time() + 10,)*2)
+    assert data_conn.read_data('claims')['ClaimNo'].tolist()==['C3']
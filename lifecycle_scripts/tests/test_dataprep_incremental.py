@@ -0,0 +1,77 @@
+import importlib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Scripts/lifecycle_dataprep.py imports the library as libs, which is Lib here
+for name in ['logger', 'connectors', 'classifier', 'state_store']:
+    sys.modules[f'libs.{name}'] = importlib.import_module(f'Lib.{name}')
+sys.modules.setdefault('libs', importlib.import_module('Lib'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Scripts'))
+
+import lifecycle_dataprep as dataprep
+from Lib.logger import Logger
+from Lib.state_store import StateStore
+
+# An incremental run after a first one gives the same outputs as a full rebuild on the same data
+
+N_CLAIMS = 100
+
+def make_claims():
+
+    rng = np.random.default_rng(2)
+    referral = pd.Timestamp('2026-01-01') + pd.to_timedelta(rng.integers(0, 250, N_CLAIMS), 'D')
+    closed = pd.Series(referral + pd.to_timedelta(rng.integers(0, 200, N_CLAIMS), 'D')).where(rng.random(N_CLAIMS)>0.4)
+
+    return pd.DataFrame({'ClaimNo': [f'C{i:04d}' for i in range(N_CLAIMS)], 'first_referral': referral, 'DateClosedLast': closed})
+
+def make_activities(claims, n, start, days, seed, types=['Travel', 'Contact', 'Report']):
+
+    rng = np.random.default_rng(seed)
+    bill_dates = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, n), 'D')
+
+    return pd.DataFrame({'ClaimNo': rng.choice(claims['ClaimNo'], n), 'BillDate': bill_dates.strftime('%Y-%m-%d 09:00:00'),
+                         'Id': np.arange(n) + seed*10**6, 'CostsTotalExTax': rng.random(n)*100,
+                         'Duration': rng.integers(0, 60, n).astype(float), 'BillType': rng.integers(1, 3, n),
+                         'type': rng.choice(types, n)})
+
+def get_scenarios():
+
+    claims = make_claims()
+    cost = make_activities(claims, 3000, '2026-01-01', 280, 1)
+
+    # billed late on the same day as the last run's latest activity
+    late = cost.loc[[cost['BillDate'].idxmax()]].assign(Id=-1, ClaimNo='C0003')
+    # Coaching only on C0005
+    coaching = cost.copy()
+    coaching.loc[coaching['ClaimNo']=='C0005', 'type'] = 'Coaching'
+    relabelled = coaching.copy()
+    relabelled.loc[relabelled['ClaimNo']=='C0005', ['type', 'BillDate']] = ['Contact', '2026-12-01 09:00:00']
+    added = pd.concat([cost, make_activities(claims, 30, '2026-11-01', 5, 3, ['Coaching'])], ignore_index=True)
+
+    return {
+        'same_day': (claims, cost, claims, pd.concat([cost, late], ignore_index=True)),
+        'type_removed': (claims, coaching, claims[claims['ClaimNo']!='C0005'], coaching[coaching['ClaimNo']!='C0005']),
+        'type_relabelled': (claims, coaching, claims, relabelled),
+        'type_added': (claims, cost, claims, added),
+        'unchanged': (claims, coaching, claims, coaching),
+    }
+
+SCENARIOS = get_scenarios()
+
+@pytest.mark.parametrize('scenario', list(SCENARIOS))
+def test_incremental_matches_full_rebuild(tmp_path, scenario):
+
+    claims_before, cost_before, claims, cost = SCENARIOS[scenario]
+    variants = dataprep.get_variants({'variants': [{'suffix': ''}, {'suffix': '_ex_travel', 'exclude_types': ['Travel']}]})
+
+    dataprep.update_outputs(Logger(console=False), StateStore(str(tmp_path / 'inc')), claims_before, cost_before, variants)
+    incremental = dataprep.update_outputs(Logger(console=False), StateStore(str(tmp_path / 'inc')), claims, cost, variants)
+    full = dataprep.update_outputs(Logger(console=False), StateStore(str(tmp_path / 'full')), claims, cost, variants)
+
+    assert sorted(incremental)==sorted(full)
+    for name in full:
+        pd.testing.assert_frame_equal(incremental[name], full[name], obj=name)
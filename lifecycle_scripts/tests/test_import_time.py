@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+# Small jobs that only need the logger shouldn't pay for pandas or the Azure SDK when importing Lib
+IMPORT_BUDGET_SECONDS = 0.5
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from Lib import Logger
+seconds = time.perf_counter() - start
+heavy = sorted({name.split('.')[0] for name in sys.modules} & {'pandas', 'numpy', 'azure', 'pyodbc'})
+print(json.dumps({'seconds': seconds, 'heavy': heavy}))
+'''
+
+def test_logger_import_is_light():
+
+    # in a fresh interpreter, so nothing is imported already
+    lib_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', SCRIPT], cwd=lib_parent, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout)
+
+    assert result['heavy']==[]
+    assert result['seconds']<IMPORT_BUDGET_SECONDS
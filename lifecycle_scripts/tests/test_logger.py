@@ -0,0 +1,57 @@
+import json
+import os
+
+from Lib.logger import Logger
+
+# Logger levels, history and json lines sink
+
+def test_level_filtering():
+
+    logger = Logger(level='WARN', console=False)
+    assert not logger.is_enabled('DEBUG')
+    assert logger.is_enabled('ERROR')
+
+    logger.debug('dropped')
+    logger.warning('kept')
+    logger.error('also kept')
+    assert [log['severity'] for log in logger.logs]==['WARN', 'ERROR']
+
+    # flags are set even for messages that are dropped
+    logger = Logger(level='ERROR', console=False)
+    logger.warning('dropped')
+    assert logger.warning_detected
+    assert len(logger.logs)==0
+
+def test_history_keeps_the_most_recent():
+
+    logger = Logger(max_logs=3, console=False)
+    for i in range(10):
+        logger.debug(f'message {i}')
+
+    assert [log['message'] for log in logger.logs]==['message 7', 'message 8', 'message 9']
+
+def test_console_output(capsys):
+
+    logger = Logger(level='WARN')
+    logger.debug('not printed')
+    logger.warning('printed')
+
+    out = capsys.readouterr().out
+    assert 'printed' in out and 'not printed' not in out
+
+def test_json_lines_sink_rotation(tmp_path):
+
+    path = str(tmp_path / 'logs' / 'run.jsonl')
+    # max_file_mb of ~1KB, so the file is rotated a few times
+    logger = Logger(log_file=path, max_file_mb=1/1024, backup_count=2, console=False)
+    for i in range(100):
+        logger.debug(f'message {i:03d} ' + 'x'*50)
+    logger.close()
+
+    assert sorted(os.listdir(tmp_path / 'logs'))==['run.jsonl', 'run.jsonl.1', 'run.jsonl.2']
+    assert os.path.getsize(path)<=1024
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records[-1]['message'].startswith('message 099')
+    assert records[-1]['severity']=='DEBUG'
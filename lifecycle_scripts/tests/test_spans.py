@@ -0,0 +1,65 @@
+import json
+
+import pandas as pd
+import pytest
+
+from Lib.logger import Logger, traced
+from Lib.utils import no_dups
+
+# Logger spans, traced and the Chrome trace
+
+@traced
+def double_rows(logger, df):
+
+    return pd.concat([df, df])
+
+@traced(name='fails')
+def fail(logger):
+
+    raise ValueError('failed')
+
+def test_traced_rows_and_summary():
+
+    logger = Logger(console=False)
+    df = pd.DataFrame({'a': range(5)})
+    double_rows(logger, df)
+    double_rows(logger, df)
+
+    span = logger.spans[-1]
+    assert span['name']=='double_rows'
+    assert (span['rows_in'], span['rows_out'])==(5, 10)
+
+    row = logger.get_span_summary()[0]
+    assert (row['name'], row['calls'], row['rows_in'], row['rows_out'])==('double_rows', 2, 10, 20)
+
+def test_nested_spans_and_errors():
+
+    logger = Logger(console=False)
+    with logger.span('outer', 3) as span:
+        with pytest.raises(ValueError):
+            fail(logger)
+        span.rows_out = 2
+
+    inner, outer = logger.spans
+    assert (inner['name'], inner['depth'], inner['error'])==('fails', 1, 'ValueError')
+    assert (outer['name'], outer['depth'], outer['error'])==('outer', 0, None)
+    assert (outer['rows_in'], outer['rows_out'])==(3, 2)
+    assert outer['wall']>=inner['wall']
+
+def test_utils_traced():
+
+    # utils is imported relatively, so it works as Lib.utils as well as libs.utils
+    logger = Logger(console=False)
+    assert no_dups(logger, pd.DataFrame({'id': [1, 2, 2]}), 'id') is False
+    assert logger.spans[-1]['name']=='no_dups'
+
+def test_write_trace(tmp_path):
+
+    logger = Logger(console=False)
+    with logger.span('stage'):
+        pass
+    logger.write_trace(str(tmp_path / 'trace.json'))
+
+    with open(tmp_path / 'trace.json') as f:
+        events = json.load(f)['traceEvents']
+    assert [(event['name'], event['ph']) for event in events]==[('stage', 'X')]
@@ -0,0 +1,79 @@
+import os
+import stat
+
+import pandas as pd
+import pytest
+
+from Lib.connectors import DataConnector
+from Lib.file_utils import UMASK, atomic_path
+from Lib.logger import Logger
+
+# DataConnector.write_data to local files
+
+def make_connector(tmp_path):
+
+    return DataConnector(Logger(console=False), None, str(tmp_path), True, str(tmp_path))
+
+def get_mode(path):
+
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def read_output(path, fmt):
+
+    if fmt=='csv':
+        return pd.read_csv(path)
+
+    return pd.read_parquet(path) if fmt=='parquet' else pd.read_feather(path)
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet', 'feather'])
+def test_write_and_insert(tmp_path, fmt):
+
+    data_conn = make_connector(tmp_path)
+    first = pd.DataFrame({'ClaimNo': ['C1', 'C2'], 'Cost': [1.5, 2.5]})
+    second = pd.DataFrame({'ClaimNo': ['C3'], 'Cost': [3.5]})
+
+    data_conn.write_data(first, 'out', fmt=fmt)
+    path = data_conn.get_output_path('out', fmt)
+    pd.testing.assert_frame_equal(read_output(path, fmt), first)
+
+    data_conn.write_data(second, 'out', insert=True, fmt=fmt)
+    pd.testing.assert_frame_equal(read_output(path, fmt), pd.concat([first, second], ignore_index=True))
+
+    # replaced without insert
+    data_conn.write_data(second, 'out', fmt=fmt)
+    pd.testing.assert_frame_equal(read_output(path, fmt), second)
+
+    # the mode a plain open() gives, not mkstemp's 0600, and no temp files left behind
+    assert get_mode(path)==0o666 & ~UMASK
+    assert os.listdir(tmp_path)==[os.path.basename(path)]
+    assert not any(log['severity']=='ERROR' for log in data_conn.logger.logs)
+
+def test_write_partitioned(tmp_path):
+
+    data_conn = make_connector(tmp_path)
+    df = pd.DataFrame({'ClaimNo': ['C1', 'C2', 'C3'], 'BillType': [1, 1, 2]})
+
+    data_conn.write_data(df, 'out', fmt='parquet', partition_cols=['BillType'])
+    path = data_conn.get_output_path('out', 'parquet')
+
+    assert get_mode(path)==0o777 & ~UMASK
+    result = pd.read_parquet(path).sort_values('ClaimNo')
+    assert result['ClaimNo'].tolist()==['C1', 'C2', 'C3']
+    assert result['BillType'].astype(int).tolist()==[1, 1, 2]
+
+def test_atomic_path_failure(tmp_path):
+
+    path = str(tmp_path / 'out.csv')
+    with open(path, 'w') as f:
+        f.write('old')
+
+    with pytest.raises(ValueError):
+        with atomic_path(path) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                f.write('new')
+            raise ValueError('failed part way')
+
+    # the old file is untouched and the temp file removed
+    with open(path) as f:
+        assert f.read()=='old'
+    assert os.listdir(tmp_path)==['out.csv']